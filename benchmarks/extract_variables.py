@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of the extraction of the variables of an http_request node from its response.
+
+It compares the previous implementation, which decoded the body as JSON and as text,
+wrapped the document in a RecursiveDict to resolve each path and rendered each value
+with jinja, with the precompiled JSONPath extraction used by HTTPRequest.extract_variables.
+
+Run it from the root of the repository:
+
+    python -m benchmarks.extract_variables
+"""
+
+from __future__ import annotations
+
+import json
+from timeit import Timer
+from typing import Dict
+
+from jinja2 import Template
+from mautrix.util.config import RecursiveDict
+from ruamel.yaml.comments import CommentedMap
+
+from menuflow.utils.json_path import JSONPath, convert_to_bool, typed_value
+from menuflow.utils.response_body import decode_json
+
+VARIABLES = {"total": "meta.total", "page": "meta.page", "news": "data", "active": "meta.active"}
+
+
+def make_body(items: int) -> bytes:
+    return json.dumps(
+        {
+            "meta": {"total": items, "page": 1, "active": "true"},
+            "data": [
+                {"title": f"title {i}", "content": "lorem ipsum " * 20, "tags": ["a", "b"]}
+                for i in range(items)
+            ],
+        }
+    ).encode()
+
+
+def legacy_extract(body: bytes) -> Dict:
+    response_data = json.loads(body.decode())
+    body.decode()
+    serialized_data = RecursiveDict(CommentedMap(**response_data))
+    variables = {}
+    for variable, path in VARIABLES.items():
+        value = serialized_data[path]
+        rendered = Template(value if isinstance(value, str) else json.dumps(value)).render()
+        try:
+            variables[variable] = convert_to_bool(json.loads(rendered))
+        except json.JSONDecodeError:
+            variables[variable] = convert_to_bool(rendered)
+    return variables
+
+
+PATHS = {variable: JSONPath(path) for variable, path in VARIABLES.items()}
+
+
+def current_extract(body: bytes) -> Dict:
+    response_data = decode_json(body, "application/json")
+    return {variable: typed_value(path.resolve(response_data)) for variable, path in PATHS.items()}
+
+
+def main() -> None:
+    # Both implementations must extract the same variables
+    body = make_body(10)
+    assert legacy_extract(body) == current_extract(body)
+
+    print(
+        f"{'items':>6} {'size (KiB)':>11} {'legacy (ms)':>12} {'compiled (ms)':>14} {'speedup':>8}"
+    )
+    for items, number in ((10, 500), (100, 100), (1000, 20)):
+        body = make_body(items)
+        before = Timer(lambda: legacy_extract(body)).timeit(number=number) / number * 1000
+        after = Timer(lambda: current_extract(body)).timeit(number=number) / number * 1000
+        print(
+            f"{items:>6} {len(body) / 1024:>11.1f} {before:>12.3f} {after:>14.3f} "
+            f"{before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of the filtering of stale events done by MatrixHandler.handle_sync.
+
+It compares the previous implementation, which made a deepcopy of the whole sync response
+and compared timestamps, with MatrixHandler.filter_sync on synthetic sync responses
+of different sizes.
+
+Run it from the root of the repository:
+
+    python -m benchmarks.handle_sync
+"""
+
+from __future__ import annotations
+
+from copy import deepcopy
+from timeit import Timer
+from types import SimpleNamespace
+from typing import Dict
+
+from menuflow.matrix import MatrixHandler
+from menuflow.utils.lru_cache import LRUCache
+
+BOT_MXID = "@menubot:example.com"
+TIMELINE_LIMIT = 50
+
+
+def make_sync(rooms: int, events: int = TIMELINE_LIMIT) -> Dict:
+    """It builds a sync response where the bot joins every room in the middle of the timeline"""
+    join = {}
+    for room in range(rooms):
+        timeline = []
+        for index in range(events):
+            evt = {
+                "type": "m.room.message",
+                "event_id": f"$event{room}-{index}",
+                "sender": f"@user{room}:example.com",
+                "origin_server_ts": 1_000_000 + index,
+                "content": {"msgtype": "m.text", "body": f"message {index}" * 4},
+                "unsigned": {"age": 1000},
+            }
+            if index == events // 2:
+                evt.update(
+                    {
+                        "type": "m.room.member",
+                        "state_key": BOT_MXID,
+                        "content": {"membership": "join", "displayname": "menubot"},
+                    }
+                )
+            timeline.append(evt)
+        join[f"!room{room}:example.com"] = {
+            "timeline": {"events": timeline, "limited": False, "prev_batch": "t1"},
+            "state": {"events": []},
+            "ephemeral": {"events": []},
+        }
+    return {"next_batch": "s1", "rooms": {"join": join}}
+
+
+def legacy_filter_sync(handler: SimpleNamespace, data: Dict) -> None:
+    aux_data = deepcopy(data)
+    for room_id, room_data in aux_data.get("rooms", {}).get("join", {}).items():
+        for i in range(len(room_data.get("timeline", {}).get("events", [])) - 1, -1, -1):
+            evt = room_data.get("timeline", {}).get("events", [])[i]
+            if (
+                handler.LAST_JOIN_EVENT.get(room_id)
+                and evt.get("origin_server_ts") <= handler.LAST_JOIN_EVENT[room_id]
+            ):
+                del data["rooms"]["join"][room_id]["timeline"]["events"][i]
+                continue
+
+            if evt.get("type", "") == "m.room.member" and evt.get("state_key", "") == handler.mxid:
+                if evt.get("content", {}).get("membership") == "join":
+                    handler.LAST_JOIN_EVENT[room_id] = evt.get("origin_server_ts")
+
+
+def make_handler() -> SimpleNamespace:
+    return SimpleNamespace(
+        mxid=BOT_MXID,
+        LAST_JOIN_EVENT={},
+        seen_events=LRUCache(maxsize=10000),
+        sync_stats={"duplicates": 0, "stale": 0},
+    )
+
+
+def bench(filter_sync, rooms: int, number: int) -> float:
+    payloads = [make_sync(rooms) for _ in range(number)]
+    handlers = [make_handler() for _ in range(number)]
+    runs = iter(zip(handlers, payloads))
+    elapsed = Timer(lambda: filter_sync(*next(runs))).timeit(number=number)
+    return elapsed / number * 1000
+
+
+def main() -> None:
+    # Both implementations must leave the same events
+    legacy, current = make_sync(5), make_sync(5)
+    legacy_filter_sync(make_handler(), legacy)
+    MatrixHandler.filter_sync(make_handler(), current)
+    assert legacy == current
+
+    # A sync received twice doesn't deliver any event the second time
+    handler, duplicated = make_handler(), make_sync(5)
+    MatrixHandler.filter_sync(handler, deepcopy(duplicated))
+    MatrixHandler.filter_sync(handler, duplicated)
+    assert not any(room["timeline"]["events"] for room in duplicated["rooms"]["join"].values())
+
+    print(
+        f"{'rooms':>6} {'events':>8} {'deepcopy (ms)':>14} {'single pass (ms)':>17} {'speedup':>8}"
+    )
+    for rooms, number in ((1, 200), (10, 100), (100, 20), (500, 5)):
+        before = bench(legacy_filter_sync, rooms, number)
+        after = bench(MatrixHandler.filter_sync, rooms, number)
+        print(
+            f"{rooms:>6} {rooms * TIMELINE_LIMIT:>8} {before:>14.3f} {after:>17.3f} "
+            f"{before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
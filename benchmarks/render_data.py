@@ -0,0 +1,55 @@
+"""
+Micro-benchmark of the rendering of the data of an http_request node.
+
+It compares the previous implementation, which serialized the whole structure as JSON,
+rendered it as a single jinja template and parsed it again, with the DataTemplate used by
+the nodes, which only renders the templated strings compiled when the flow is loaded.
+
+Run it from the root of the repository:
+
+    python -m benchmarks.render_data
+"""
+
+from __future__ import annotations
+
+from json import dumps, loads
+from timeit import Timer
+from typing import Any, Dict
+
+from menuflow.jinja.jinja_template import DataTemplate, get_template
+from menuflow.utils.json_path import convert_to_bool
+
+VARIABLES = {"customer": "Ana", "phone": "3001234567", "option": "2", "active": "true"}
+
+
+def make_data(fields: int) -> Dict[str, Any]:
+    data = {
+        "customer": {"name": "{{customer}}", "phone": "{{phone}}", "active": "{{active}}"},
+        "option": "{{option}}",
+    }
+    data.update(
+        {f"field_{i}": {"value": f"static value {i}", "tags": ["a", "b"]} for i in range(fields)}
+    )
+    return data
+
+
+def legacy_render(data: Dict[str, Any]) -> Any:
+    return convert_to_bool(loads(get_template(dumps(data)).render(**VARIABLES)))
+
+
+def main() -> None:
+    # Both implementations must render the same data
+    data = make_data(10)
+    assert legacy_render(data) == DataTemplate(data).render(VARIABLES)
+
+    print(f"{'fields':>7} {'legacy (us)':>12} {'compiled (us)':>14} {'speedup':>8}")
+    for fields, number in ((0, 5000), (10, 2000), (100, 500)):
+        data = make_data(fields)
+        template = DataTemplate(data)
+        before = Timer(lambda: legacy_render(data)).timeit(number=number) / number * 1e6
+        after = Timer(lambda: template.render(VARIABLES)).timeit(number=number) / number * 1e6
+        print(f"{fields:>7} {before:>12.1f} {after:>14.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
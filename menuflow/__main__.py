@@ -9,8 +9,17 @@ from .api import init as init_api
 from .config import Config
 from .db import init as init_db
 from .db import upgrade_table
+from .http_pool import http_pool
+from .jinja.jinja_template import template_cache
 from .menu import MenuClient
+from .response_cache import response_cache
+from .room import Room
 from .server import MenuFlowServer
+from .token_store import token_store
+from .upstreams import upstreams
+from .user import User
+from .utils.markdown_cache import markdown_cache
+from .webhooks import webhook_queue
 
 
 class MenuFlow(Program):
@@ -39,10 +48,22 @@ class MenuFlow(Program):
         )
         init_db(self.db)
 
+    def prepare_caches(self) -> None:
+        template_cache.maxsize = self.config["menuflow.cache.templates"]
+        markdown_cache.maxsize = self.config["menuflow.cache.markdown"]
+        token_store.init(self.config)
+        http_pool.init(self.config)
+        response_cache.init(self.config)
+        upstreams.init(self.config)
+        webhook_queue.init(self.config)
+
     def prepare(self) -> None:
         super().prepare()
         self.prepare_db()
+        self.prepare_caches()
         MenuClient.init_cls(self)
+        Room.init_cls(self.config)
+        User.init_cls(self.config)
         management_api = init_api(self.config, self.loop)
         self.server = MenuFlowServer(management_api, self.config, self.loop)
 
@@ -65,6 +86,7 @@ class MenuFlow(Program):
 
     async def start(self) -> None:
         await self.start_db()
+        await webhook_queue.start()
         await asyncio.gather(*[menu.start() async for menu in MenuClient.all()])
         await super().start()
         await self.server.start()
@@ -77,6 +99,11 @@ class MenuFlow(Program):
             await asyncio.wait_for(self.server.stop(), 5)
         except asyncio.TimeoutError:
             self.log.warning("Stopping server timed out")
+        self.log.debug("Saving pending room changes")
+        await Room.flush_all()
+        await webhook_queue.stop()
+        await http_pool.close()
+        await response_cache.close()
         await self.db.stop()
 
 
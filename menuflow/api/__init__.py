@@ -5,9 +5,10 @@ from aiohttp import web
 import menuflow
 
 from ..config import Config
+from . import stats
 from .base import routes, set_config
 
-all_endpoints = ["client"]
+all_endpoints = ["client", "stats"]
 
 
 def init(cfg: Config, loop: AbstractEventLoop) -> web.Application:
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+from aiohttp import web
+
+from ..http_pool import http_pool
+from ..jinja.jinja_template import template_cache
+from ..menu import MenuClient
+from ..response_cache import response_cache
+from ..room import Room
+from ..token_store import token_store
+from ..upstreams import upstreams
+from ..user import User
+from ..utils.markdown_cache import markdown_cache
+from ..webhooks import webhook_queue
+from .base import routes
+
+
+@routes.get("/stats")
+async def stats(_: web.Request) -> web.Response:
+    return web.json_response(
+        {
+            "template_cache": template_cache.stats,
+            "markdown_cache": markdown_cache.stats,
+            "room_cache": Room.by_room_id.stats,
+            "user_cache": User.by_mxid.stats,
+            "middleware_tokens": token_store.stats,
+            "http_pool": http_pool.stats,
+            "response_cache": response_cache.stats,
+            "upstreams": upstreams.stats,
+            "webhooks": webhook_queue.stats,
+            "clients": {
+                client.id: {
+                    "mailboxes": client.matrix_handler.mailbox_stats,
+                    "send_queue": client.matrix_handler.send_queue.stats,
+                    "executor": client.matrix_handler.executor_stats,
+                    "sync": {
+                        **client.matrix_handler.sync_stats,
+                        "dedup_window": len(client.matrix_handler.seen_events),
+                    },
+                }
+                for client in MenuClient.cache.values()
+            },
+        }
+    )
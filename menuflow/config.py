@@ -19,6 +19,34 @@ class Config(BaseFileConfig):
         copy("menuflow.database_opts")
         copy("menuflow.timeouts.http_requests")
         copy("menuflow.timeouts.middlewares")
+        copy("menuflow.http_client.limit")
+        copy("menuflow.http_client.limit_per_host")
+        copy("menuflow.http_client.keepalive_timeout")
+        copy("menuflow.http_client.dns_cache_ttl")
+        copy("menuflow.http_client.max_body_size")
+        copy("menuflow.upstreams.default")
+        copy("menuflow.upstreams.middlewares")
+        copy("menuflow.upstreams.hosts")
+        copy("menuflow.webhooks.queue_size")
+        copy("menuflow.webhooks.workers")
+        copy("menuflow.webhooks.retries")
+        copy("menuflow.webhooks.backoff")
+        copy("menuflow.cache.templates")
+        copy("menuflow.cache.markdown")
+        copy("menuflow.cache.rooms")
+        copy("menuflow.cache.users")
+        copy("menuflow.cache.idle_ttl")
+        copy("menuflow.cache.responses")
+        copy("menuflow.cache.responses_store")
+        copy("menuflow.room_state.flush_deadline")
+        copy("menuflow.executor.max_steps")
+        copy("menuflow.sync.dedup_window")
+        copy("menuflow.flows.artifacts_dir")
+        copy("menuflow.send_queue.rate")
+        copy("menuflow.send_queue.burst")
+        copy("menuflow.send_queue.max_retries")
+        copy("menuflow.send_queue.retry_after")
+        copy("menuflow.tokens.refresh_margin")
         copy("server.hostname")
         copy("server.port")
         copy("server.public_url")
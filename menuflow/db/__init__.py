@@ -1,14 +1,16 @@
 from mautrix.util.async_db import Database
 
 from .client import Client
+from .middleware_token import MiddlewareToken
 from .migrations import upgrade_table
 from .room import Room
 from .user import User
+from .webhook_job import WebhookJob
 
 
 def init(db: Database) -> None:
-    for table in (Room, User, Client):
+    for table in (Room, User, Client, MiddlewareToken, WebhookJob):
         table.db = db
 
 
-__all__ = ["upgrade_table", "Room", "User", "Client"]
+__all__ = ["upgrade_table", "Room", "User", "Client", "MiddlewareToken", "WebhookJob"]
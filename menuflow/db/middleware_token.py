@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, ClassVar
+
+from asyncpg import Record
+from attr import dataclass
+from mautrix.util.async_db import Database
+
+fake_db = Database.create("") if TYPE_CHECKING else None
+
+
+@dataclass
+class MiddlewareToken:
+
+    db: ClassVar[Database] = fake_db
+
+    key: str
+    middleware_id: str
+    token: str
+    expires_at: float | None = None
+
+    @classmethod
+    def _from_row(cls, row: Record) -> MiddlewareToken | None:
+        return cls(**row)
+
+    @property
+    def values(self) -> tuple:
+        return (self.key, self.middleware_id, self.token, self.expires_at)
+
+    _columns = "key, middleware_id, token, expires_at"
+
+    async def upsert(self) -> None:
+        q = (
+            f"INSERT INTO middleware_token ({self._columns}) VALUES ($1, $2, $3, $4) "
+            "ON CONFLICT (key) DO UPDATE SET middleware_id=excluded.middleware_id, "
+            "token=excluded.token, expires_at=excluded.expires_at"
+        )
+        await self.db.execute(q, *self.values)
+
+    @classmethod
+    async def get(cls, key: str) -> MiddlewareToken | None:
+        q = f"SELECT {cls._columns} FROM middleware_token WHERE key=$1"
+        row = await cls.db.fetchrow(q, key)
+
+        if not row:
+            return
+
+        return cls._from_row(row)
@@ -36,3 +36,41 @@ async def upgrade_v1(conn: Connection) -> None:
     )
 
     await conn.execute("ALTER TABLE room ADD CONSTRAINT idx_unique_room_id UNIQUE (room_id)")
+
+
+@upgrade_table.register(description="Store the room variables as JSONB")
+async def upgrade_v2(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE room ALTER COLUMN variables TYPE JSONB USING variables::jsonb")
+
+
+@upgrade_table.register(description="Add a unique index to the user mxid")
+async def upgrade_v3(conn: Connection) -> None:
+    await conn.execute('DELETE FROM "user" a USING "user" b WHERE a.mxid = b.mxid AND a.id > b.id')
+    await conn.execute('CREATE UNIQUE INDEX idx_unique_user_mxid ON "user" (mxid)')
+
+
+@upgrade_table.register(description="Store the tokens of the middlewares")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE middleware_token (
+            key           TEXT PRIMARY KEY,
+            middleware_id TEXT NOT NULL,
+            token         TEXT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Store the expiration of the middleware tokens")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE middleware_token ADD COLUMN expires_at DOUBLE PRECISION")
+
+
+@upgrade_table.register(description="Spool of the pending webhooks")
+async def upgrade_v6(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE webhook_job (
+            id         SERIAL PRIMARY KEY,
+            request    JSONB NOT NULL,
+            created_at DOUBLE PRECISION NOT NULL
+        )"""
+    )
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
+import json
 from enum import Enum
-from typing import TYPE_CHECKING, ClassVar, Dict
+from typing import TYPE_CHECKING, Any, ClassVar, Dict
 
 from asyncpg import Record
 from attr import dataclass
@@ -46,6 +47,22 @@ class Room:
         q = "UPDATE room SET variables = $2, node_id = $3, state = $4 WHERE room_id = $1"
         await self.db.execute(q, *self.values)
 
+    async def update_changes(self, variables: Dict[str, Any]) -> None:
+        """It saves the node_id and the state of the room,
+        and only the variables that have changed instead of the whole document.
+
+        Parameters
+        ----------
+        variables : Dict[str, Any]
+            The variables that have changed, they are merged into the stored ones.
+
+        """
+        q = (
+            "UPDATE room SET variables = COALESCE(variables, '{}'::jsonb) || $2::jsonb, "
+            "node_id = $3, state = $4 WHERE room_id = $1"
+        )
+        await self.db.execute(q, self.room_id, json.dumps(variables), self.node_id, self.state)
+
     @classmethod
     async def get_by_room_id(cls, room_id: RoomID) -> Room | None:
         q = f"SELECT id, {cls._columns} FROM room WHERE room_id=$1"
@@ -55,3 +72,34 @@ class Room:
             return
 
         return cls._from_row(row)
+
+    @classmethod
+    async def get_or_create(cls, room_id: RoomID, node_id: str) -> Room:
+        """It gets a room from the database, inserting it if it doesn't exist,
+        in a single round trip
+
+        Parameters
+        ----------
+        room_id : RoomID
+            The room's ID.
+        node_id : str
+            The node where the room starts if it is created.
+
+        Returns
+        -------
+            The room object
+
+        """
+        q = (
+            f"WITH inserted AS (INSERT INTO room ({cls._columns}) VALUES ($1, '{{}}', $2, NULL) "
+            f"ON CONFLICT (room_id) DO NOTHING RETURNING id, {cls._columns}) "
+            f"SELECT id, {cls._columns} FROM inserted UNION ALL "
+            f"SELECT id, {cls._columns} FROM room WHERE room_id=$1 LIMIT 1"
+        )
+        row = await cls.db.fetchrow(q, room_id, node_id)
+
+        if not row:
+            # The room was inserted by a concurrent transaction which was not yet visible
+            return await cls.get_by_room_id(room_id)
+
+        return cls._from_row(row)
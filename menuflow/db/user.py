@@ -39,3 +39,32 @@ class User:
             return
 
         return cls._from_row(row)
+
+    @classmethod
+    async def get_or_create(cls, mxid: UserID) -> User:
+        """It gets a user from the database, inserting it if it doesn't exist,
+        in a single round trip
+
+        Parameters
+        ----------
+        mxid : UserID
+            The user's ID.
+
+        Returns
+        -------
+            The user object
+
+        """
+        q = (
+            'WITH inserted AS (INSERT INTO "user" (mxid) VALUES ($1) '
+            "ON CONFLICT (mxid) DO NOTHING RETURNING id, mxid) "
+            'SELECT id, mxid FROM inserted UNION ALL SELECT id, mxid FROM "user" WHERE mxid=$1 '
+            "LIMIT 1"
+        )
+        row = await cls.db.fetchrow(q, mxid)
+
+        if not row:
+            # The user was inserted by a concurrent transaction which was not yet visible
+            return await cls.get_by_mxid(mxid)
+
+        return cls._from_row(row)
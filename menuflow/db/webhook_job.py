@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import json
+from typing import TYPE_CHECKING, Any, ClassVar, Dict, List
+
+from asyncpg import Record
+from attr import dataclass
+from mautrix.util.async_db import Database
+
+fake_db = Database.create("") if TYPE_CHECKING else None
+
+
+@dataclass
+class WebhookJob:
+
+    db: ClassVar[Database] = fake_db
+
+    id: int | None
+    request: Dict[str, Any]
+    created_at: float
+
+    @classmethod
+    def _from_row(cls, row: Record) -> WebhookJob | None:
+        data = dict(row)
+        if isinstance(data["request"], str):
+            data["request"] = json.loads(data["request"])
+        return cls(**data)
+
+    async def insert(self) -> None:
+        q = "INSERT INTO webhook_job (request, created_at) VALUES ($1::jsonb, $2) RETURNING id"
+        self.id = await self.db.fetchval(q, json.dumps(self.request), self.created_at)
+
+    async def delete(self) -> None:
+        await self.db.execute("DELETE FROM webhook_job WHERE id=$1", self.id)
+
+    @classmethod
+    async def get_last_id(cls) -> int | None:
+        return await cls.db.fetchval("SELECT max(id) FROM webhook_job")
+
+    @classmethod
+    async def get_pending(cls, limit: int, after_id: int, until_id: int) -> List[WebhookJob]:
+        q = (
+            "SELECT id, request, created_at FROM webhook_job WHERE id > $1 AND id <= $2 "
+            "ORDER BY id LIMIT $3"
+        )
+        return [cls._from_row(row) for row in await cls.db.fetch(q, after_id, until_id, limit)]
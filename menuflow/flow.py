@@ -8,10 +8,19 @@ from mautrix.types import SerializableAttrs
 from mautrix.util.logging import TraceLogger
 
 from .middlewares.http import HTTPMiddleware
-from .nodes import HTTPRequest, Input, Message, Switch
+from .nodes import HTTPRequest, Input, Message, ParallelRequest, Switch, Webhook
 from .nodes.flow_object import FlowObject
 from .room import Room
 
+NODE_TYPES: Dict[str, FlowObject] = {
+    "message": Message,
+    "input": Input,
+    "http_request": HTTPRequest,
+    "switch": Switch,
+    "parallel_request": ParallelRequest,
+    "webhook": Webhook,
+}
+
 
 @dataclass
 class Flow(SerializableAttrs):
@@ -20,109 +29,75 @@ class Flow(SerializableAttrs):
     middlewares: List[HTTPMiddleware] = ib(default=None, metadata={"json": "middlewares"})
     flow_variables: Dict[str, Any] = ib(default=None, metadata={"json": "flow_variables"})
 
-    nodes_by_id: Dict[str, FlowObject] = {}
-    middlewares_by_id: Dict[str, HTTPMiddleware] = {}
+    nodes_by_id: Dict[str, FlowObject] = ib(factory=dict, metadata={"hidden": True})
+    middlewares_by_id: Dict[str, HTTPMiddleware] = ib(factory=dict, metadata={"hidden": True})
 
     log: TraceLogger = logging.getLogger("menuflow.flow")
 
-    def _add_to_cache(self, obj: FlowObject | HTTPMiddleware):
-        if isinstance(obj, HTTPMiddleware):
-            self.middlewares_by_id[obj.id] = obj
-        elif isinstance(obj, FlowObject):
-            self.nodes_by_id[obj.id] = obj
+    def __attrs_post_init__(self) -> None:
+        self.compile()
 
-    def get_node_by_id(self, node_id: str) -> Message | Input | HTTPRequest | Switch | None:
-        try:
-            return self.nodes_by_id[node_id]
-        except KeyError:
-            pass
+    def compile(self) -> None:
+        """It builds the typed nodes and middlewares of the flow.
 
-        for node in self.nodes:
-            if node_id == node.id:
-                self._add_to_cache(node)
-                return node
+        It is done only once, when the flow is loaded, the built objects are shared by all
+        the rooms and they must not be modified, the state of each execution travels
+        in a FlowContext.
+        """
 
-    def get_middleware_by_id(self, middleware_id: str) -> HTTPMiddleware | None:
-        if not self.middlewares:
-            return
-
-        try:
-            return self.middlewares_by_id[middleware_id]
-        except KeyError:
-            pass
-
-        for middleware in self.middlewares:
-            if middleware_id == middleware.id:
-                self._add_to_cache(middleware)
-                return middleware
-
-    def build_object(
-        self,
-        data: Dict,
-        type_class: Message | Input | HTTPRequest | Switch | HTTPMiddleware | None,
-    ) -> Message | Input | HTTPRequest | Switch | HTTPMiddleware | None:
-        """It takes a dictionary of data and a class, and returns an instance of that class
+        self.nodes_by_id = {}
+        for node in self.nodes or []:
+            try:
+                node_class = NODE_TYPES[node.type]
+            except KeyError:
+                self.log.warning(f"The node [{node.id}] has an unknown [type: {node.type}]")
+                continue
 
-        Parameters
-        ----------
-        data : Dict
-            The data to deserialize.
-        type_class : Message | Input | HTTPRequest | Switch | HTTPMiddleware | None
-            The class of the middleware to be built.
+            self.nodes_by_id[node.id] = node_class.deserialize(node.serialize())
 
-        Returns
-        -------
-            A deserialized instance of the type_class.
+        self.middlewares_by_id = {}
+        for middleware in self.middlewares or []:
+            self.middlewares_by_id[middleware.id] = HTTPMiddleware.deserialize(
+                middleware.serialize()
+            )
 
-        """
-        return type_class.deserialize(data)
+        if not self.flow_variables:
+            self.flow_variables = {}
+        elif not isinstance(self.flow_variables, dict):
+            self.flow_variables = self.flow_variables.serialize()
 
-    def node(self, room: Room) -> Message | Input | HTTPRequest | None:
+    def get_node_by_id(self, node_id: str) -> Message | Input | HTTPRequest | Switch | None:
+        return self.nodes_by_id.get(node_id)
 
-        node = self.get_node_by_id(node_id=room.node_id)
+    def get_middleware_by_id(self, middleware_id: str) -> HTTPMiddleware | None:
+        return self.middlewares_by_id.get(middleware_id)
 
-        if not node:
-            return
+    def node(self, room: Room) -> Message | Input | HTTPRequest | Switch | None:
+        """It returns the node where the room is.
 
-        node.room = room
-        node.flow_variables = self.flow_variables
+        Parameters
+        ----------
+        room : Room
+            The room whose node is wanted.
 
-        if node.type == "message":
-            node = self.build_object(node.serialize(), Message)
-        elif node.type == "input":
-            node = self.build_object(node.serialize(), Input)
-        elif node.type == "http_request":
-            node = self.build_object(node.serialize(), HTTPRequest)
-        elif node.type == "switch":
-            node = self.build_object(node.serialize(), Switch)
-        else:
-            return
+        Returns
+        -------
+            The node object, it is shared by all the rooms so it must not be modified.
 
-        return node
+        """
+        return self.nodes_by_id.get(room.node_id)
 
-    def middleware(self, room: Room, middleware_id: str) -> HTTPMiddleware | None:
+    def middleware(self, middleware_id: str) -> HTTPMiddleware | None:
         """It returns the middleware object.
 
         Parameters
         ----------
-        room : Room
-            The room that the middleware is being called from.
         middleware_id : str
             The ID of the middleware you want to get.
 
         Returns
         -------
-            A middleware object
+            A middleware object, it is shared by all the rooms so it must not be modified.
 
         """
-
-        middleware: HTTPMiddleware = self.get_middleware_by_id(middleware_id=middleware_id)
-
-        if not middleware:
-            return
-
-        middleware.room = room
-        middleware.flow_variables = self.flow_variables
-        middleware = self.build_object(middleware.serialize(), HTTPMiddleware)
-
-        return middleware
+        return self.middlewares_by_id.get(middleware_id)
@@ -0,0 +1,402 @@
+"""
+The flow compiler validates a flow and caches it, already parsed, in an artifact keyed by the
+SHA-256 of its YAML, so the next time the bot starts the YAML is not parsed again.
+The artifacts are plain JSON, loading one can't run any code.
+
+It is used by the bots when they start, and it can be run to check the flows before
+deploying them:
+
+    python -m menuflow.flow_compiler /data/flows/@bot:example.com.yaml
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import sys
+from hashlib import sha256
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from attr import dataclass
+from jinja2 import TemplateSyntaxError
+from mautrix.types import SerializableAttrs
+from mautrix.util.logging import TraceLogger
+from ruamel.yaml import YAML
+
+from .db.room import RoomState
+from .flow import NODE_TYPES, Flow
+from .jinja.jinja_template import get_template, is_template
+from .nodes import HTTPRequest, Input, ParallelRequest, Switch, Webhook
+from .nodes.flow_object import FlowObject
+
+# It must be increased when the format of the artifacts changes
+ARTIFACT_VERSION = 3
+
+log: TraceLogger = logging.getLogger("menuflow.flow_compiler")
+
+
+@dataclass
+class FlowIssue(SerializableAttrs):
+    """A problem found in a flow, the errors break the flow at runtime"""
+
+    ERROR = "error"
+    WARNING = "warning"
+
+    level: str
+    message: str
+    node_id: str = None
+
+    def __str__(self) -> str:
+        node = f"[node: {self.node_id}] " if self.node_id else ""
+        return f"{self.level}: {node}{self.message}"
+
+
+def _connections(node: FlowObject) -> Iterator[Tuple[str, str]]:
+    """The nodes a node can transit to, with the field that points to each one"""
+    if getattr(node, "o_connection", None):
+        yield "o_connection", str(node.o_connection)
+
+    for case in getattr(node, "cases", None) or []:
+        if case.o_connection:
+            yield f"case {case.id}", str(case.o_connection)
+
+
+def _may_change_variables(node: FlowObject) -> bool:
+    # The webhooks don't read the response, so they can't change the variables
+    if isinstance(node, (HTTPRequest, ParallelRequest)) and not isinstance(node, Webhook):
+        return True
+
+    if isinstance(node, Switch):
+        return any(case["variables"] for case in node._cases_by_id.values())
+
+    return False
+
+
+def _strongly_connected(graph: Dict[str, List[str]]) -> List[List[str]]:
+    """Tarjan's algorithm, iterative so the long flows don't hit the recursion limit"""
+    index: Dict[str, int] = {}
+    lowlink: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack: Set[str] = set()
+    components = []
+
+    for root in graph:
+        if root in index:
+            continue
+
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph[successor])))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+
+    return components
+
+
+def _check_templates(owner: FlowObject, issues: List[FlowIssue], node_id: str = None) -> None:
+    """It compiles the templates that are not compiled when the flow is built,
+    so they are in the template cache and their syntax errors are found now
+    """
+    fields = ["text", "url", "validation", "token_type"]
+    sources = [(field, getattr(owner, field, None)) for field in fields]
+    for case in getattr(owner, "cases", None) or []:
+        variables = getattr(case, "variables", None) or {}
+        if not isinstance(variables, dict):
+            variables = variables.__dict__
+        sources += [(f"case {case.id}", value) for value in variables.values()]
+
+    for field, source in sources:
+        if not isinstance(source, str) or not is_template(source):
+            continue
+        try:
+            get_template(source)
+        except TemplateSyntaxError as e:
+            issues.append(
+                FlowIssue(FlowIssue.ERROR, f"the {field} has an invalid template: {e}", node_id)
+            )
+
+
+def analyze(flow: Flow, raw_nodes: List[Dict] = None) -> List[FlowIssue]:
+    """It looks for the problems of a flow that would only show up at runtime
+
+    Parameters
+    ----------
+    flow : Flow
+        The flow, already built.
+    raw_nodes : List[Dict]
+        The nodes as they are in the YAML, to find the duplicated IDs and the unknown types.
+
+    Returns
+    -------
+        The errors and warnings found.
+
+    """
+
+    issues: List[FlowIssue] = []
+
+    def error(message: str, node_id: str = None) -> None:
+        issues.append(FlowIssue(FlowIssue.ERROR, message, node_id))
+
+    def warning(message: str, node_id: str = None) -> None:
+        issues.append(FlowIssue(FlowIssue.WARNING, message, node_id))
+
+    seen_ids = set()
+    for raw_node in raw_nodes or []:
+        node_id = str(raw_node.get("id"))
+        if node_id in seen_ids:
+            error("the ID is used by more than one node", node_id)
+        seen_ids.add(node_id)
+        if raw_node.get("type") not in NODE_TYPES:
+            error(f"the type {raw_node.get('type')} is unknown", node_id)
+
+    nodes = flow.nodes_by_id
+    start = RoomState.START.value
+    if start not in nodes:
+        error(f"there is no node with the ID {start}, the rooms start there")
+
+    graph: Dict[str, List[str]] = {}
+    for node_id, node in nodes.items():
+        graph[node_id] = []
+        for field, target in _connections(node):
+            if target in nodes:
+                graph[node_id].append(target)
+            else:
+                error(f"the {field} goes to the node {target}, that doesn't exist", node_id)
+
+        if isinstance(node, Switch) and node.cases and "default" not in node._cases_by_id:
+            # The http requests only need it for the statuses without a case
+            if isinstance(node, (HTTPRequest, ParallelRequest)):
+                warning("there is no default case", node_id)
+            else:
+                error("there is no default case", node_id)
+
+        requests = node.requests if isinstance(node, ParallelRequest) else [node]
+        for request in requests:
+            middleware = getattr(request, "middleware", None)
+            if middleware and middleware not in flow.middlewares_by_id:
+                error(f"the middleware {middleware} doesn't exist", node_id)
+            if getattr(request, "cache", None) and not request._cacheable:
+                warning("the cache is only used by GET and HEAD requests", node_id)
+
+        _check_templates(node, issues, node_id)
+        for request in node.requests if isinstance(node, ParallelRequest) else []:
+            _check_templates(request, issues, node_id)
+
+    for middleware in flow.middlewares_by_id.values():
+        _check_templates(middleware, issues, f"middleware {middleware.id}")
+
+    # The nodes that can't be reached from the start node
+    reachable = set()
+    pending = [start] if start in nodes else []
+    while pending:
+        node_id = pending.pop()
+        if node_id not in reachable:
+            reachable.add(node_id)
+            pending.extend(graph[node_id])
+    if start in nodes:
+        for node_id in nodes.keys() - reachable:
+            warning("the node can't be reached from the start node", node_id)
+
+    # The loops that don't wait for the user nor change any variable never make progress,
+    # the executor stops them at runtime
+    for component in _strongly_connected(graph):
+        if len(component) == 1 and component[0] not in graph[component[0]]:
+            continue
+        if any(
+            isinstance(nodes[node_id], Input) or _may_change_variables(nodes[node_id])
+            for node_id in component
+        ):
+            continue
+        warning(
+            f"the nodes {', '.join(sorted(component))} form a loop that doesn't wait for "
+            "the user nor change any variable",
+            sorted(component)[0],
+        )
+
+    return issues
+
+
+def compile_source(source: bytes) -> Tuple[Flow, Dict[str, Any]]:
+    """It parses the YAML of a flow, builds the flow and analyzes it
+
+    Parameters
+    ----------
+    source : bytes
+        The YAML of the flow.
+
+    Returns
+    -------
+        The flow and its artifact: the parsed flow and the issues found.
+
+    """
+
+    menu = YAML(typ="safe").load(source)["menu"]
+    flow = Flow.deserialize(menu)
+    issues = analyze(flow, menu.get("nodes"))
+    artifact = {
+        "version": ARTIFACT_VERSION,
+        "source": sha256(source).hexdigest(),
+        "menu": menu,
+        "issues": [issue.serialize() for issue in issues],
+    }
+    return flow, artifact
+
+
+def _artifact_path(path: str, digest: str, artifacts_dir: str = None) -> str:
+    artifacts_dir = artifacts_dir or os.path.join(os.path.dirname(path), ".compiled")
+    return os.path.join(artifacts_dir, f"{os.path.basename(path)}.{digest}.json")
+
+
+def _read_artifact(artifact_path: str, digest: str) -> Dict[str, Any] | None:
+    try:
+        with open(artifact_path, "rb") as file:
+            artifact = json.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning(f"The artifact {artifact_path} can't be read, it will be compiled again: {e}")
+        return None
+
+    if (
+        not isinstance(artifact, dict)
+        or artifact.get("version") != ARTIFACT_VERSION
+        or artifact.get("source") != digest
+    ):
+        return None
+
+    return artifact
+
+
+def _write_artifact(path: str, artifact_path: str, artifact: Dict[str, Any]) -> None:
+    artifacts_dir = os.path.dirname(artifact_path)
+    try:
+        os.makedirs(artifacts_dir, exist_ok=True)
+        # It is written to a temporary file first, so a bot never reads a partial artifact
+        data = json.dumps(artifact, separators=(",", ":"))
+        temporary_path = f"{artifact_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(temporary_path, artifact_path)
+
+        # The artifacts of the previous versions of the flow are not needed anymore,
+        # nor the ones saved by older versions of menuflow
+        prefix = f"{os.path.basename(path)}."
+        for name in os.listdir(artifacts_dir):
+            old_path = os.path.join(artifacts_dir, name)
+            if (
+                name.startswith(prefix)
+                and name.endswith((".json", ".flow"))
+                and old_path != artifact_path
+            ):
+                os.remove(old_path)
+    except (OSError, TypeError, ValueError) as e:
+        # The YAML values that JSON doesn't have, like the dates, can't be saved
+        log.warning(f"The artifact {artifact_path} can't be saved: {e}")
+
+
+def load_flow(path: str, artifacts_dir: str = None) -> Flow:
+    """It loads a flow from its artifact, the flow is compiled if it has changed
+
+    Parameters
+    ----------
+    path : str
+        The path of the YAML of the flow.
+    artifacts_dir : str
+        The directory of the artifacts, by default the .compiled directory next to the flow.
+
+    Returns
+    -------
+        The flow, its errors and warnings are logged.
+
+    """
+
+    with open(path, "rb") as file:
+        source = file.read()
+
+    digest = sha256(source).hexdigest()
+    artifact_path = _artifact_path(path, digest, artifacts_dir)
+    artifact = _read_artifact(artifact_path, digest)
+    if artifact:
+        flow = Flow.deserialize(artifact["menu"])
+        log.debug(f"The flow {path} has been loaded from {artifact_path}")
+    else:
+        flow, artifact = compile_source(source)
+        _write_artifact(path, artifact_path, artifact)
+        log.debug(f"The flow {path} has been compiled to {artifact_path}")
+
+    for issue in artifact["issues"]:
+        issue = FlowIssue.deserialize(issue)
+        if issue.level == FlowIssue.ERROR:
+            log.error(f"{path}: {issue}")
+        else:
+            log.warning(f"{path}: {issue}")
+
+    return flow
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m menuflow.flow_compiler",
+        description="Validate flows and compile them to the artifacts loaded by the bots.",
+    )
+    parser.add_argument("flows", nargs="+", metavar="flow", help="the YAML files of the flows")
+    parser.add_argument(
+        "--artifacts-dir",
+        help="where the artifacts are saved, by default the .compiled directory of each flow",
+    )
+    parser.add_argument(
+        "--check", action="store_true", help="only validate the flows, don't save the artifacts"
+    )
+    args = parser.parse_args(argv)
+
+    errors = 0
+    for path in args.flows:
+        try:
+            with open(path, "rb") as file:
+                source = file.read()
+            _, artifact = compile_source(source)
+        except Exception as e:
+            print(f"{path}: error: the flow can't be built: {e}")
+            errors += 1
+            continue
+
+        issues = [FlowIssue.deserialize(issue) for issue in artifact["issues"]]
+        for issue in issues:
+            print(f"{path}: {issue}")
+        errors += sum(issue.level == FlowIssue.ERROR for issue in issues)
+
+        if not args.check:
+            artifact_path = _artifact_path(path, sha256(source).hexdigest(), args.artifacts_dir)
+            _write_artifact(path, artifact_path, artifact)
+            print(f"{path}: compiled to {artifact_path}")
+
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,12 +3,15 @@ from __future__ import annotations
 import base64
 from logging import getLogger
 from types import SimpleNamespace
-from typing import Dict
+from typing import TYPE_CHECKING, Dict
 
 from aiohttp import ClientSession, TraceRequestEndParams, TraceRequestStartParams
 from mautrix.util.logging import TraceLogger
 
-from .room import Room
+from .token_store import token_store
+
+if TYPE_CHECKING:
+    from .nodes.flow_object import FlowContext
 
 log: TraceLogger = getLogger("menuflow.middleware")
 
@@ -36,6 +39,7 @@ async def start_auth_middleware(
 
     context_params: Dict = trace_request_ctx["trace_request_ctx"]
     middleware = context_params.get("middleware")
+    context: FlowContext = context_params.get("context")
 
     if not middleware:
         log.info(f"There's no define middleware for this request: {params.url}")
@@ -45,26 +49,31 @@ async def start_auth_middleware(
         log.info(f"The request url do not match with the meddleware url")
         return
 
-    params.headers.update(middleware._general_headers)
+    params.headers.update(middleware._general_headers(context))
 
     if middleware.type == "jwt":
-        room: Room = await Room.get_by_room_id(room_id=context_params.get("customer_room_id"))
-        room_variables: Dict = middleware.auth.variables.__dict__
-        token_key: str = list(room_variables.keys())[0]
-
-        if not await room.get_variable(token_key):
-            await middleware.auth_request(session=session)
-
-        params.headers.update(
-            {"Authorization": f"{middleware._token_type} {await room.get_variable(token_key)}"}
+        # The requests made in the background don't change the room, it may be running
+        # another event by then
+        background = bool(context_params.get("background"))
+        token = await token_store.get_token(
+            middleware, context, session, save_variables=not background
         )
+        # The token used is kept to know if it has already been refreshed when it is rejected
+        trace_config_ctx.token = token
+
+        # The flows can still read the token from the room variables
+        if (
+            token
+            and not background
+            and await context.room.get_variable(middleware._token_variable) != token
+        ):
+            await context.room.set_variable(middleware._token_variable, token)
+
+        params.headers.update({"Authorization": f"{middleware._token_type(context)} {token}"})
     elif middleware.type == "basic":
         log.info(f"middleware: {middleware.id} type: {middleware.type} executing ...")
-        auth_str = (
-            f"{middleware._basic_auth['login']}:{middleware._basic_auth['password']}".encode(
-                "utf-8"
-            )
-        )
+        basic_auth = middleware._basic_auth(context)
+        auth_str = f"{basic_auth['login']}:{basic_auth['password']}".encode("utf-8")
         params.headers.update({"Authorization": f"Basic {base64.b64encode(auth_str).decode()}"})
 
 
@@ -94,6 +103,7 @@ async def end_auth_middleware(
 
     context_params: Dict = trace_request_ctx["trace_request_ctx"]
     middleware = context_params.get("middleware")
+    context: FlowContext = context_params.get("context")
 
     if not middleware:
         log.info(f"There's no define middleware for this request: {params.url}")
@@ -106,4 +116,10 @@ async def end_auth_middleware(
 
         if middleware.type == "jwt":
             log.info("Token expired, refreshing token ...")
-            await middleware.auth_request(session=session)
+            await token_store.refresh(
+                middleware,
+                context,
+                session,
+                stale_token=getattr(trace_config_ctx, "token", None),
+                save_variables=not context_params.get("background"),
+            )
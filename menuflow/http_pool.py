@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import logging
+from time import monotonic
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from aiohttp import (
+    ClientSession,
+    TCPConnector,
+    TraceConfig,
+    TraceConnectionCreateEndParams,
+    TraceConnectionCreateStartParams,
+)
+from mautrix.util.logging import TraceLogger
+
+from .config import Config
+from .http_middlewares import end_auth_middleware, start_auth_middleware
+from .utils.single_flight import SingleFlight
+
+
+class HTTPPool:
+    """The connection pool used by the http_request nodes of all the clients.
+
+    It is separated from the sessions of the clients, so the slow APIs called by the flows
+    can't take the connections needed to sync with the homeserver. The session is created
+    when it is first used, because it must be created inside the event loop.
+
+    The identical requests that are made at the same time can be coalesced,
+    so only one of them reaches the API and all of them share its response.
+    """
+
+    log: TraceLogger = logging.getLogger("menuflow.http_pool")
+
+    def __init__(self) -> None:
+        self.limit = 100
+        self.limit_per_host = 10
+        self.keepalive_timeout = 30
+        self.dns_cache_ttl = 300
+        self._session: ClientSession | None = None
+        self._coalesced = SingleFlight()
+        self.in_flight = 0
+        self.queued = 0
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connect_time = 0.0
+        self.max_connect_time = 0.0
+
+    def init(self, config: Config) -> None:
+        self.limit = config["menuflow.http_client.limit"]
+        self.limit_per_host = config["menuflow.http_client.limit_per_host"]
+        self.keepalive_timeout = config["menuflow.http_client.keepalive_timeout"]
+        self.dns_cache_ttl = config["menuflow.http_client.dns_cache_ttl"]
+
+    @property
+    def session(self) -> ClientSession:
+        if not self._session or self._session.closed:
+            connector = TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = ClientSession(
+                connector=connector, trace_configs=[self._auth_trace(), self._stats_trace()]
+            )
+            self.log.debug(
+                f"HTTP pool created limit: {self.limit} limit_per_host: {self.limit_per_host}"
+            )
+        return self._session
+
+    async def coalesce(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """It makes the request, unless an identical one is in flight,
+        in that case it waits for its response
+
+        Parameters
+        ----------
+        key : Hashable
+            The key that identifies the request.
+        fetch : Callable[[], Awaitable[Any]]
+            The function that makes the request and reads the response.
+
+        Returns
+        -------
+            The response read by fetch, it is shared by the callers so it must not be modified.
+
+        """
+        return await self._coalesced.run(key, fetch)
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    def _auth_trace() -> TraceConfig:
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(start_auth_middleware)
+        trace_config.on_request_end.append(end_auth_middleware)
+        return trace_config
+
+    def _stats_trace(self) -> TraceConfig:
+        async def request_start(*_) -> None:
+            self.requests += 1
+            self.in_flight += 1
+
+        async def request_done(*_) -> None:
+            self.in_flight -= 1
+
+        async def queued_start(*_) -> None:
+            self.queued += 1
+
+        async def queued_end(*_) -> None:
+            self.queued -= 1
+
+        async def create_start(
+            _, trace_config_ctx: SimpleNamespace, __: TraceConnectionCreateStartParams
+        ) -> None:
+            trace_config_ctx.connect_start = monotonic()
+
+        async def create_end(
+            _, trace_config_ctx: SimpleNamespace, __: TraceConnectionCreateEndParams
+        ) -> None:
+            elapsed = monotonic() - trace_config_ctx.connect_start
+            self.connections_created += 1
+            self.connect_time += elapsed
+            self.max_connect_time = max(self.max_connect_time, elapsed)
+
+        async def connection_reused(*_) -> None:
+            self.connections_reused += 1
+
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(request_start)
+        trace_config.on_request_end.append(request_done)
+        trace_config.on_request_exception.append(request_done)
+        trace_config.on_connection_queued_start.append(queued_start)
+        trace_config.on_connection_queued_end.append(queued_end)
+        trace_config.on_connection_create_start.append(create_start)
+        trace_config.on_connection_create_end.append(create_end)
+        trace_config.on_connection_reuseconn.append(connection_reused)
+        return trace_config
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "avg_connect_time": (
+                self.connect_time / self.connections_created if self.connections_created else 0
+            ),
+            "max_connect_time": self.max_connect_time,
+            "coalesced_requests": self._coalesced.shared,
+        }
+
+
+http_pool = HTTPPool()
@@ -1,9 +1,13 @@
 from datetime import datetime
-from re import match
+from re import DOTALL, compile, match
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
 
-from jinja2 import BaseLoader, Environment
+from jinja2 import BaseLoader, Environment, Template, TemplateSyntaxError, Undefined
 from jinja2_ansible_filters import AnsibleCoreFiltersExtension
 
+from ..utils.json_path import convert_to_bool
+from ..utils.lru_cache import LRUCache
+
 jinja_env = Environment(
     autoescape=True, loader=BaseLoader, extensions=[AnsibleCoreFiltersExtension]
 )
@@ -36,3 +40,224 @@ Validates if a pattern matches a variable
 e.g
 {{ match("^(0[1-9]|[12][0-9]|3[01])\s(0[1-9]|1[012])\s(19[0-9][0-9]|20[0-9][0-9])$", "14 09 1999") }}
 """
+
+data_env = jinja_env.overlay(autoescape=False)
+"""
+The same environment without autoescaping, the values sent to the APIs are not HTML.
+"""
+
+
+template_cache = LRUCache()
+"""
+Compiled templates shared by every client of the process, keyed by the template source.
+"""
+
+
+def is_template(source: str) -> bool:
+    """It checks if the source has jinja syntax, the sources without it render to themselves
+
+    Parameters
+    ----------
+    source : str
+        The text to check.
+
+    Returns
+    -------
+        True if the source has any expression, statement or comment.
+
+    """
+
+    return any(
+        delimiter in source
+        for delimiter in (
+            jinja_env.variable_start_string,
+            jinja_env.block_start_string,
+            jinja_env.comment_start_string,
+        )
+    )
+
+
+def render(template: Template, variables: Mapping[str, Any]) -> str:
+    """It renders a template without copying the variables
+
+    Parameters
+    ----------
+    template : Template
+        The compiled template.
+    variables : Mapping[str, Any]
+        The variables, they must include the globals of the environment.
+
+    Returns
+    -------
+        The rendered template.
+
+    """
+
+    context = template.new_context(variables, shared=True)
+    try:
+        return template.environment.concat(template.root_render_func(context))
+    except Exception:
+        return template.environment.handle_exception()
+
+
+EXPRESSION_REGEX = compile(r"^\{\{-?(.+?)-?\}\}$", DOTALL)
+
+
+def compile_expression(source: str) -> Optional[Template]:
+    """It compiles a template that only has an expression, like {{ opt.isdigit() }},
+    so its value can be evaluated without rendering it as text
+
+    Parameters
+    ----------
+    source : str
+        The jinja template source.
+
+    Returns
+    -------
+        The compiled expression or None if the source is not a single expression.
+
+    """
+
+    expression = EXPRESSION_REGEX.match(source)
+    if not expression or "{{" in expression.group(1) or "}}" in expression.group(1):
+        return None
+
+    try:
+        # It fails if the source has more than an expression
+        jinja_env.compile_expression(expression.group(1))
+        return jinja_env.from_string(f"{{% set result = {expression.group(1)} %}}")
+    except TemplateSyntaxError:
+        return None
+
+
+def evaluate(expression: Template, variables: Mapping[str, Any]) -> Any:
+    """It evaluates an expression compiled by compile_expression without copying the variables
+
+    Parameters
+    ----------
+    expression : Template
+        The compiled expression.
+    variables : Mapping[str, Any]
+        The variables, they must include the globals of the environment.
+
+    Returns
+    -------
+        The value of the expression, the undefined values are empty strings
+        like when they are rendered.
+
+    """
+
+    context = expression.new_context(variables, shared=True)
+    try:
+        for _ in expression.root_render_func(context):
+            pass
+    except Exception:
+        return expression.environment.handle_exception()
+
+    result = context.vars.get("result")
+    return str(result) if isinstance(result, Undefined) else result
+
+
+def get_template(source: str, autoescape: bool = True) -> Template:
+    """It returns the compiled template of the source,
+    the source is only compiled the first time it is requested
+
+    Parameters
+    ----------
+    source : str
+        The jinja template source.
+    autoescape : bool
+        If the rendered values are HTML escaped, it is disabled for the data of the requests.
+
+    Returns
+    -------
+        The compiled template.
+
+    """
+
+    key = source if autoescape else ("data", source)
+    template: Template = template_cache.get(key)
+
+    if template is None:
+        template = (jinja_env if autoescape else data_env).from_string(source)
+        template_cache[key] = template
+
+    return template
+
+
+class DataTemplate:
+    """A string, dict or list whose strings can have jinja syntax, compiled once.
+
+    Each templated string is compiled and rendered on its own, without HTML escaping, so the
+    rendered values are never parsed again and a variable with quotes or backslashes can't
+    break the structure.
+    The parts without jinja syntax are built once and shared by all the renders, so the
+    rendered data must not be modified.
+    """
+
+    def __init__(self, data: Any) -> None:
+        self.static, self._render = self._compile(data)
+
+    @property
+    def is_static(self) -> bool:
+        return self._render is None
+
+    def render(self, variables: Mapping[str, Any]) -> Any:
+        """It renders the templated strings with the variables,
+        the strings true and false are converted to booleans
+
+        Parameters
+        ----------
+        variables : Mapping[str, Any]
+            The variables used to render the templates.
+
+        Returns
+        -------
+            The data with the same structure and the templated strings rendered.
+
+        """
+
+        return self.static if self._render is None else self._render(variables)
+
+    @classmethod
+    def _compile(cls, data: Any) -> Tuple[Any, Optional[Callable[[Mapping], Any]]]:
+        if isinstance(data, str):
+            if not is_template(data):
+                return convert_to_bool(data), None
+            template = get_template(data, autoescape=False)
+            return None, lambda variables: convert_to_bool(render(template, variables))
+
+        if isinstance(data, dict):
+            items = [(cls._compile_key(key), cls._compile(value)) for key, value in data.items()]
+            if all(key[1] is None and value[1] is None for key, value in items):
+                return {key[0]: value[0] for key, value in items}, None
+
+            def render_dict(variables: Mapping[str, Any]) -> Dict:
+                return {
+                    (key if key_render is None else key_render(variables)): (
+                        value if value_render is None else value_render(variables)
+                    )
+                    for (key, key_render), (value, value_render) in items
+                }
+
+            return None, render_dict
+
+        if isinstance(data, (list, tuple)):
+            items = [cls._compile(item) for item in data]
+            if all(render is None for _, render in items):
+                return [item for item, _ in items], None
+
+            def render_list(variables: Mapping[str, Any]) -> list:
+                return [item if render is None else render(variables) for item, render in items]
+
+            return None, render_list
+
+        return data, None
+
+    @staticmethod
+    def _compile_key(key: Any) -> Tuple[Any, Optional[Callable[[Mapping], Any]]]:
+        # The keys are rendered but, unlike the values, they are never converted to booleans
+        if not isinstance(key, str) or not is_template(key):
+            return key, None
+        template = get_template(key, autoescape=False)
+        return None, lambda variables: render(template, variables)
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import asyncio
-from copy import deepcopy
-from typing import Dict, Optional
+from collections import deque
+from functools import partial
+from time import monotonic
+from typing import Awaitable, Callable, Deque, Dict, Optional
 
 from mautrix.client import Client as MatrixClient
 from mautrix.types import (
@@ -18,47 +20,154 @@ from mautrix.types import (
 
 from .config import Config
 from .db.room import RoomState
-from .flow import Flow
+from .flow_compiler import load_flow
+from .http_pool import http_pool
+from .nodes import HTTPRequest, Input, Message, Switch
+from .nodes.flow_object import FlowContext
 from .room import Room
+from .send_queue import SendQueue
 from .user import User
+from .utils.lru_cache import LRUCache
 from .utils.util import Util
 
 
+class RoomMailbox:
+    """The pending jobs of a room, they are run one at a time and in the order they arrived
+    by a task that only lives while there are jobs in the mailbox.
+    """
+
+    def __init__(self, room_id: RoomID) -> None:
+        self.room_id = room_id
+        self.jobs: Deque[Callable[[], Awaitable[None]]] = deque()
+        self.task: asyncio.Task | None = None
+
+
 class MatrixHandler(MatrixClient):
 
-    LAST_JOIN_EVENT: Dict[RoomID, int] = {}
-    LOCKED_ROOMS = set()
     HTTP_ATTEMPTS: Dict = {}
 
     def __init__(self, config: Config, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self.config = config
-        flow = Config(path=f"/data/flows/{self.mxid}.yaml", base_path="")
-        flow.load()
-        self.flow = Flow.deserialize(flow["menu"])
+        # The flow is loaded from its compiled artifact, it is only parsed when it changes
+        self.flow = load_flow(
+            f"/data/flows/{self.mxid}.yaml",
+            artifacts_dir=self.config["menuflow.flows.artifacts_dir"],
+        )
         self.util = Util(self.config)
+        # The IDs of the last events received, to drop the ones that are received twice
+        self.seen_events = LRUCache(maxsize=self.config["menuflow.sync.dedup_window"])
+        self.sync_stats = {"duplicates": 0, "stale": 0}
+        self.mailboxes: Dict[RoomID, RoomMailbox] = {}
+        self.processed_jobs = 0
+        self.send_queue = SendQueue(
+            send=self.send_message,
+            rate=self.config["menuflow.send_queue.rate"],
+            burst=self.config["menuflow.send_queue.burst"],
+            max_retries=self.config["menuflow.send_queue.max_retries"],
+            retry_after=self.config["menuflow.send_queue.retry_after"],
+        )
+        self.executor_stats = {
+            "runs": 0,
+            "steps": 0,
+            "max_steps": 0,
+            "time": 0.0,
+            "cycles": 0,
+            "budget_exceeded": 0,
+            # The distinct nodes visited by the runs
+            "nodes": 0,
+            "max_nodes": 0,
+        }
+
+    def dispatch(self, room_id: RoomID, job: Callable[[], Awaitable[None]]) -> None:
+        """It queues a job in the mailbox of the room.
+
+        The jobs of a room are run strictly in order, one at a time,
+        while the jobs of different rooms run in parallel.
+
+        Parameters
+        ----------
+        room_id : RoomID
+            The room the job belongs to.
+        job : Callable[[], Awaitable[None]]
+            The function that processes the event.
+
+        """
+        try:
+            mailbox = self.mailboxes[room_id]
+        except KeyError:
+            mailbox = self.mailboxes[room_id] = RoomMailbox(room_id)
+            mailbox.task = asyncio.create_task(self._run_mailbox(mailbox))
+
+        mailbox.jobs.append(job)
+
+    async def _run_mailbox(self, mailbox: RoomMailbox) -> None:
+        try:
+            while mailbox.jobs:
+                try:
+                    await mailbox.jobs[0]()
+                except Exception as e:
+                    self.log.exception(f"Error processing an event of {mailbox.room_id}: {e}")
+                finally:
+                    mailbox.jobs.popleft()
+                    self.processed_jobs += 1
+        finally:
+            # There is no await between the last check and this, so no job can be lost
+            del self.mailboxes[mailbox.room_id]
+
+    @property
+    def mailbox_stats(self) -> Dict[str, int]:
+        depths = [len(mailbox.jobs) for mailbox in self.mailboxes.values()]
+        return {
+            "rooms": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "processed": self.processed_jobs,
+        }
 
     def handle_sync(self, data: JSON) -> list[asyncio.Task]:
-        # This is a way to remove duplicate events from the sync
-        aux_data = deepcopy(data)
-        for room_id, room_data in aux_data.get("rooms", {}).get("join", {}).items():
-            for i in range(len(room_data.get("timeline", {}).get("events", [])) - 1, -1, -1):
-                evt = room_data.get("timeline", {}).get("events", [])[i]
-                if (
-                    self.LAST_JOIN_EVENT.get(room_id)
-                    and evt.get("origin_server_ts") <= self.LAST_JOIN_EVENT[room_id]
-                ):
-                    del data["rooms"]["join"][room_id]["timeline"]["events"][i]
-                    continue
+        self.filter_sync(data)
+        return super().handle_sync(data)
+
+    def filter_sync(self, data: JSON) -> None:
+        """It removes from the timelines of the sync, in place and in a single pass,
+        the events that have already been received and the events that were sent
+        before the bot joined the room.
+
+        Parameters
+        ----------
+        data : JSON
+            The response of the sync, its timelines are replaced by the filtered ones.
+
+        """
+        for room_data in data.get("rooms", {}).get("join", {}).values():
+            timeline = room_data.get("timeline")
+            if not timeline or not timeline.get("events"):
+                continue
+
+            # The events are walked from the newest one, so that the join of the bot is found
+            # before the events that were sent before it
+            events = []
+            duplicates = 0
+            for evt in reversed(timeline["events"]):
+                event_id = evt.get("event_id")
+                if event_id in self.seen_events:
+                    duplicates += 1
+                else:
+                    self.seen_events[event_id] = True
+                    events.append(evt)
 
                 if (
                     evt.get("type", "") == "m.room.member"
                     and evt.get("state_key", "") == self.mxid
+                    and evt.get("content", {}).get("membership") == "join"
                 ):
-                    if evt.get("content", {}).get("membership") == "join":
-                        self.LAST_JOIN_EVENT[room_id] = evt.get("origin_server_ts")
+                    break
 
-        return super().handle_sync(data)
+            self.sync_stats["duplicates"] += duplicates
+            self.sync_stats["stale"] += len(timeline["events"]) - len(events) - duplicates
+            events.reverse()
+            timeline["events"] = events
 
     async def handle_member(self, evt: StrippedStateEvent) -> None:
         unsigned = evt.unsigned or StateUnsigned()
@@ -72,10 +181,10 @@ class MatrixHandler(MatrixClient):
             and prev_membership != Membership.JOIN
             and evt.state_key == self.mxid
         ):
-            await self.handle_join(evt)
+            self.dispatch(evt.room_id, partial(self.handle_join, evt))
         elif evt.content.membership == Membership.LEAVE:
             if prev_membership == Membership.JOIN:
-                await self.handle_leave(evt)
+                self.dispatch(evt.room_id, partial(self.handle_leave, evt))
 
     async def handle_invite(self, evt: StrippedStateEvent):
         if self.util.ignore_user(mxid=evt.sender, origin="invite") or evt.sender == self.mxid:
@@ -85,21 +194,8 @@ class MatrixHandler(MatrixClient):
 
         await self.join_room(evt.room_id)
 
-    def unlock_room(self, room_id: RoomID):
-        self.log.debug(f"UNLOCKING ROOM... {room_id}")
-        self.LOCKED_ROOMS.discard(room_id)
-
-    def lock_room(self, room_id: RoomID):
-        self.log.debug(f"LOCKING ROOM... {room_id}")
-        self.LOCKED_ROOMS.add(room_id)
-
     async def handle_join(self, evt: StrippedStateEvent):
-        if evt.room_id in self.LOCKED_ROOMS:
-            self.log.debug(f"Ignoring menu request in {evt.room_id} Menu locked")
-            return
-
         self.log.debug(f"{evt.state_key} ACCEPTED -- EVENT JOIN ... {evt.room_id}")
-        self.lock_room(evt.room_id)
 
         try:
             room = await Room.get_by_room_id(room_id=evt.room_id)
@@ -109,10 +205,12 @@ class MatrixHandler(MatrixClient):
                 await room.set_variable("customer_room_id", evt.room_id)
         except Exception as e:
             self.log.exception(e)
-            self.unlock_room(evt.room_id)
             return
 
-        await self.algorithm(room=room)
+        try:
+            await self.algorithm(room=room)
+        finally:
+            await room.flush()
 
     async def handle_leave(self, evt: StrippedStateEvent):
         room = await Room.get_by_room_id(room_id=evt.room_id, create=False)
@@ -121,7 +219,6 @@ class MatrixHandler(MatrixClient):
             return
 
         await room.clean_up()
-        self.unlock_room(evt.room_id)
 
     async def handle_message(self, message: MessageEvent) -> None:
 
@@ -144,6 +241,10 @@ class MatrixHandler(MatrixClient):
             )
             return
 
+        # The messages of a room are processed in order, one after the other
+        self.dispatch(message.room_id, partial(self.process_message, message))
+
+    async def process_message(self, message: MessageEvent) -> None:
         try:
             user: User = await User.get_by_mxid(mxid=message.sender)
             room = await Room.get_by_room_id(room_id=message.room_id)
@@ -159,16 +260,17 @@ class MatrixHandler(MatrixClient):
         if not room:
             return
 
-        await self.algorithm(room=room, evt=message)
+        try:
+            await self.algorithm(room=room, evt=message)
+        finally:
+            await room.flush()
 
     async def algorithm(self, room: Room, evt: Optional[MessageEvent] = None) -> None:
-        """If the room is in the input state, then set the variable to the room's input,
-        and if the node has an output connection, then update the menu to the output connection.
-        Otherwise, run the node and update the menu to the output connection.
-        If the node is an input node and the room is not in the input state,
-        then show the message and update the menu to the node's id and set the state to input.
-        If the node is a message node, then show the message and if the node has an output connection,
-        then update the menu to the output connection and run the algorithm again
+        """It runs the flow of the room, one node after the other, until the flow waits for
+        the user in an input node, the flow ends, or the step budget of the event is spent.
+
+        A flow that comes back to the same node without having changed any variable of the
+        room would loop forever, so it is stopped as soon as that happens.
 
         Parameters
         ----------
@@ -177,30 +279,115 @@ class MatrixHandler(MatrixClient):
         evt : MessageEvent
             The event that triggered the algorithm.
 
+        """
+
+        context = FlowContext(
+            room=room, config=self.config, flow_variables=self.flow.flow_variables
+        )
+        max_steps = self.config["menuflow.executor.max_steps"]
+        started_at = monotonic()
+        visited_nodes = set()
+        seen_states = set()
+        steps = 0
+
+        try:
+            while True:
+                if room.state == RoomState.END.value:
+                    self.log.debug(f"The room {room.room_id} has terminated the flow")
+                    await room.update_menu(node_id=RoomState.START.value)
+                    return
+
+                node = self.flow.node(room=room)
+
+                if node is None:
+                    self.log.debug(f"Room {room.room_id} does not have a node")
+                    await room.update_menu(node_id=RoomState.START.value)
+                    return
+
+                # The same node, in the same state and with the same variables means that
+                # the flow is in a loop that won't make any progress. An http_request node
+                # is run again after a 401, each of those attempts is progress until the
+                # attempts of its middleware are spent
+                state = (
+                    node.id,
+                    room.state,
+                    room.variables_version,
+                    self.http_attempts(room=room, node=node),
+                )
+                if state in seen_states:
+                    self.log.warning(
+                        f"The [room: {room.room_id}] is in a loop without progress "
+                        f"at [node: {node.id}], the execution has been stopped"
+                    )
+                    self.executor_stats["cycles"] += 1
+                    return
+
+                if steps >= max_steps:
+                    self.log.warning(
+                        f"The [room: {room.room_id}] has spent its budget of {max_steps} steps "
+                        f"at [node: {node.id}], the execution has been stopped"
+                    )
+                    self.executor_stats["budget_exceeded"] += 1
+                    return
+
+                seen_states.add(state)
+                visited_nodes.add(node.id)
+                steps += 1
+
+                self.log.debug(
+                    f"The [room: {room.room_id}] [node: {node.id}] [state: {room.state}]"
+                )
+
+                if not await self.run_node(node=node, context=context, evt=evt):
+                    return
+        finally:
+            elapsed = monotonic() - started_at
+            self.executor_stats["runs"] += 1
+            self.executor_stats["steps"] += steps
+            self.executor_stats["max_steps"] = max(self.executor_stats["max_steps"], steps)
+            self.executor_stats["time"] += elapsed
+            self.executor_stats["nodes"] += len(visited_nodes)
+            self.executor_stats["max_nodes"] = max(
+                self.executor_stats["max_nodes"], len(visited_nodes)
+            )
+            self.log.debug(
+                f"The [room: {room.room_id}] ran {steps} steps through {len(visited_nodes)} "
+                f"nodes in {elapsed:.4f}s"
+            )
+
+    async def run_node(
+        self,
+        node: Message | Input | HTTPRequest | Switch,
+        context: FlowContext,
+        evt: Optional[MessageEvent] = None,
+    ) -> bool:
+        """It runs a single node of the flow and moves the room to the next one.
+
+        Parameters
+        ----------
+        node : Message | Input | HTTPRequest | Switch
+            The node where the room is.
+        context : FlowContext
+            The execution context of the room.
+        evt : MessageEvent
+            The event that triggered the execution.
+
         Returns
         -------
-            The return value is the result of the last expression in the function body.
+            True if the flow must go on with the next node, False if it must wait.
 
         """
 
+        room = context.room
+
         # This is the case where the room is in the input state.
         # In this case, the variable is set to the room's input, and if the node has an output connection,
         # then the menu is updated to the output connection.
         # Otherwise, the node is run and the menu is updated to the output connection.
-
-        node = self.flow.node(room=room)
-
-        if node is None:
-            self.log.debug(f"Room {room.room_id} does not have a node")
-            await room.update_menu(node_id=RoomState.START.value)
-            return
-
-        self.log.debug(f"The [room: {room.room_id}] [node: {node.id}] [state: {room.state}]")
-
         if room.state == RoomState.INPUT.value:
             if not evt:
                 self.log.warning("The [evt] is empty")
-                return
+                return False
 
             self.log.debug(f"Creating [variable: {node.variable}] [content: {evt.content.body}]")
             try:
@@ -211,97 +398,113 @@ class MatrixHandler(MatrixClient):
             except ValueError as e:
                 self.log.warning(e)
 
-            # If the node has an output connection, then update the menu to the output connection.
-            # Otherwise, run the node and update the menu to the output connection.
-
-            await room.update_menu(node_id=node.o_connection or await node.run())
-
-        node = self.flow.node(room=room)
+            await room.update_menu(node_id=node.o_connection or await node.run(context))
+            return True
 
         if node.type == "switch":
-            await room.update_menu(await node.run())
-
-        node = self.flow.node(room=room)
+            await room.update_menu(await node.run(context))
+            return True
 
         # This is the case where the room is not in the input state and the node is an input node.
         # In this case, the message is shown and the menu is updated to the node's id and the state is set to input.
-        if node and node.type == RoomState.INPUT.value and room.state != RoomState.INPUT.value:
+        if node.type == RoomState.INPUT.value:
             self.log.debug(f"Room {room.room_id} enters input node {node.id}")
-            await node.show_message(room_id=room.room_id, client=self)
+            await node.show_message(context=context, client=self)
             await room.update_menu(node_id=node.id, state=RoomState.INPUT.value)
-            return
+            return False
 
         # Showing the message and updating the menu to the output connection.
-        if node and node.type == "message":
+        if node.type == "message":
             self.log.debug(f"Room {room.room_id} enters message node {node.id}")
-            await node.show_message(room_id=room.room_id, client=self)
+            await node.show_message(context=context, client=self)
 
             await room.update_menu(
                 node_id=node.o_connection,
                 state=RoomState.END.value if not node.o_connection else None,
             )
+            return True
 
-        node = self.flow.node(room=room)
+        if node.type == "http_request":
+            return await self.run_http_request(node=node, context=context)
 
-        if node and node.type == "http_request":
-            node.config = self.config
-            middleware = self.flow.middleware(room=room, middleware_id=node.middleware)
+        if node.type == "parallel_request":
+            o_connection = await node.run(
+                context=context, session=http_pool.session, get_middleware=self.flow.middleware
+            )
+            await room.update_menu(node_id=o_connection, state=None)
+            return True
 
-            if middleware:
-                middleware.config = self.config
+        if node.type == "webhook":
+            self.log.debug(f"Room {room.room_id} enters webhook node {node.id}")
+            await node.run(context)
+            await room.update_menu(
+                node_id=node.o_connection,
+                state=RoomState.END.value if not node.o_connection else None,
+            )
+            return True
 
-            self.log.debug(f"Room {room.room_id} enters http_request node {node.id}")
-            try:
-                status, response = await node.request(
-                    session=self.api.session, middleware=middleware
-                )
-                self.log.info(f"http_request node {node.id} had a status of {status}")
-
-                if status == 401:
-                    self.HTTP_ATTEMPTS.update(
-                        {
-                            room.room_id: {
-                                "last_http_node": node.id,
-                                "attempts_count": self.HTTP_ATTEMPTS.get(room.room_id).get(
-                                    "attempts_count"
-                                )
-                                + 1
-                                if self.HTTP_ATTEMPTS.get(room.room_id)
-                                else 1,
-                            }
+        return False
+
+    def http_attempts(self, room: Room, node: HTTPRequest) -> int:
+        """The 401 responses that the http_request node has got in a row in the room,
+        only the nodes with a middleware are run again after a 401
+        """
+        attempts = self.HTTP_ATTEMPTS.get(room.room_id)
+        if not getattr(node, "middleware", None) or not attempts:
+            return 0
+
+        return attempts["attempts_count"] if attempts["last_http_node"] == node.id else 0
+
+    async def run_http_request(self, node: HTTPRequest, context: FlowContext) -> bool:
+        room = context.room
+        middleware = self.flow.middleware(middleware_id=node.middleware)
+
+        self.log.debug(f"Room {room.room_id} enters http_request node {node.id}")
+        try:
+            status, response = await node.request(
+                context=context, session=http_pool.session, middleware=middleware
+            )
+            self.log.info(f"http_request node {node.id} had a status of {status}")
+
+            if status == 401:
+                self.HTTP_ATTEMPTS.update(
+                    {
+                        room.room_id: {
+                            "last_http_node": node.id,
+                            "attempts_count": self.HTTP_ATTEMPTS.get(room.room_id).get(
+                                "attempts_count"
+                            )
+                            + 1
+                            if self.HTTP_ATTEMPTS.get(room.room_id)
+                            else 1,
                         }
-                    )
-                    self.log.debug(
-                        "HTTP auth attempt"
-                        f"{self.HTTP_ATTEMPTS[room.room_id]['attempts_count']}, trying again ..."
-                    )
+                    }
+                )
+                self.log.debug(
+                    "HTTP auth attempt"
+                    f"{self.HTTP_ATTEMPTS[room.room_id]['attempts_count']}, trying again ..."
+                )
 
-                if not status in [200, 201]:
-                    self.log.error(response)
-                else:
-                    self.HTTP_ATTEMPTS.update(
-                        {room.room_id: {"last_http_node": None, "attempts_count": 0}}
-                    )
-            except Exception as e:
-                self.log.exception(e)
-                return
-
-            if (
-                self.HTTP_ATTEMPTS.get(room.room_id)
-                and self.HTTP_ATTEMPTS[room.room_id]["last_http_node"] == node.id
-                and self.HTTP_ATTEMPTS[room.room_id]["attempts_count"] >= middleware._attempts
-            ):
-                self.log.debug("Attempts limit reached, o_connection set as `default`")
+            if not status in [200, 201]:
+                self.log.error(response)
+            else:
                 self.HTTP_ATTEMPTS.update(
                     {room.room_id: {"last_http_node": None, "attempts_count": 0}}
                 )
-                await room.update_menu(await node.get_case_by_id("default"), None)
-
-        node = self.flow.node(room=room)
+        except Exception as e:
+            self.log.exception(e)
+            return False
 
-        if room.state == RoomState.END.value:
-            self.log.debug(f"The room {room.room_id} has terminated the flow")
-            await room.update_menu(node_id=RoomState.START.value)
-            return
+        if (
+            middleware
+            and self.HTTP_ATTEMPTS.get(room.room_id)
+            and self.HTTP_ATTEMPTS[room.room_id]["last_http_node"] == node.id
+            and self.HTTP_ATTEMPTS[room.room_id]["attempts_count"] >= middleware._attempts
+        ):
+            self.log.debug("Attempts limit reached, o_connection set as `default`")
+            self.HTTP_ATTEMPTS.update(
+                {room.room_id: {"last_http_node": None, "attempts_count": 0}}
+            )
+            await room.update_menu(await node.get_case_by_id("default", context), None)
 
-        await self.algorithm(room=room, evt=evt)
+        return True
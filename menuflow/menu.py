@@ -5,7 +5,7 @@ import logging
 from collections import defaultdict
 from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, cast
 
-from aiohttp import ClientSession, TraceConfig
+from aiohttp import ClientSession
 from mautrix.client import Client, InternalEventType
 from mautrix.errors import MatrixInvalidToken
 from mautrix.types import (
@@ -24,8 +24,8 @@ from mautrix.util.async_getter_lock import async_getter_lock
 from mautrix.util.logging import TraceLogger
 
 from .db import Client as DBClient
-from .http_middlewares import end_auth_middleware, start_auth_middleware
 from .matrix import MatrixHandler
+from .send_queue import rate_limit_trace
 
 if TYPE_CHECKING:
     from .__main__ import MenuFlow
@@ -90,10 +90,9 @@ class MenuClient(DBClient):
         self._postinited = True
         self.cache[self.id] = self
         self.log = self.log.getChild(self.id)
-        trace_config = TraceConfig()
-        trace_config.on_request_start.append(start_auth_middleware)
-        trace_config.on_request_end.append(end_auth_middleware)
-        self.http_client = ClientSession(loop=self.menuflow.loop, trace_configs=[trace_config])
+        self.http_client = ClientSession(
+            loop=self.menuflow.loop, trace_configs=[rate_limit_trace()]
+        )
         self.started = False
         self.sync_ok = True
         self.matrix_handler: MatrixHandler = self._make_client()
@@ -1,15 +1,21 @@
 from __future__ import annotations
 
+import base64
+import binascii
+from hashlib import sha256
+from json import dumps, loads
+from time import time
 from typing import Any, Dict, Tuple
 
-from aiohttp import ClientSession, ClientTimeout, ContentTypeError
+from aiohttp import ClientSession, ClientTimeout
 from attr import dataclass, ib
 from jinja2 import Template
 from mautrix.types import SerializableAttrs
-from mautrix.util.config import RecursiveDict
-from ruamel.yaml.comments import CommentedMap
 
-from ..nodes.flow_object import FlowObject
+from ..jinja.jinja_template import DataTemplate
+from ..nodes.flow_object import FlowContext, FlowObject
+from ..utils.json_path import JSONPath, typed_value
+from ..utils.response_body import decode_json, read_body
 
 
 @dataclass
@@ -24,6 +30,8 @@ class Auth(SerializableAttrs):
     variables: Dict[str, Any] = ib(default=None, metadata={"json": "variables"})
     token_path: str = ib(default=None, metadata={"json": "token_path"})
     basic_auth: Dict[str, Any] = ib(default=None, metadata={"json": "basic_auth"})
+    expires_in: str = ib(default=None, metadata={"json": "expires_in"})
+    token_ttl: int = ib(default=None, metadata={"json": "token_ttl"})
 
 
 @dataclass
@@ -59,6 +67,11 @@ class HTTPMiddleware(FlowObject):
                     password: "secretfoo"
                 variables:
                     token: token
+                # Optional, the token is refreshed before it expires. The expiration is taken
+                # from this field of the response (seconds), from the exp claim of the token
+                # or from token_ttl (seconds), in that order.
+                expires_in: expires_in
+                token_ttl: 3600
             general:
                 headers:
                     content-type: application/json
@@ -81,81 +94,164 @@ class HTTPMiddleware(FlowObject):
     auth: Auth = ib(default=None, metadata={"json": "auth"})
     general: General = ib(default=None, metadata={"json": "general"})
 
-    @property
-    def _url(self) -> Template:
-        return self.render_data(self.url)
+    def __attrs_post_init__(self) -> None:
+        super().__attrs_post_init__()
+        # The paths of the variables and the expiration are parsed once, when the flow is loaded
+        self._variable_paths: Dict[str, JSONPath] = {}
+        self._expires_in_path: JSONPath | None = None
+        # Only the templated values of the requests are rendered in each room
+        serialized = self.serialize()
+        auth = serialized.get("auth") or {}
+        self._templates: Dict[str, DataTemplate] = {
+            field: DataTemplate(auth.get(field))
+            for field in ("cookies", "headers", "query_params", "data", "basic_auth")
+        }
+        self._templates["general_headers"] = DataTemplate(
+            (serialized.get("general") or {}).get("headers")
+        )
+        if not self.auth:
+            return
 
-    @property
-    def _token_url(self) -> Template:
+        variables = self.auth.variables
+        if variables and not isinstance(variables, dict):
+            variables = variables.serialize()
+        self._variable_paths = {
+            variable: JSONPath(path) for variable, path in (variables or {}).items()
+        }
+        if self.auth.expires_in:
+            self._expires_in_path = JSONPath(self.auth.expires_in)
+
+    def _url(self, context: FlowContext) -> Template:
+        return self.render_data(self.url, context)
+
+    def _token_url(self, context: FlowContext) -> Template:
         complete_url = f"{self.url}{self.auth.token_path}"
-        return self.render_data(complete_url)
+        return self.render_data(complete_url, context)
 
-    @property
-    def _token_type(self) -> Template:
-        return self.render_data(self.token_type)
+    def _token_type(self, context: FlowContext) -> Template:
+        return self.render_data(self.token_type, context)
 
     @property
     def _attempts(self) -> int:
         return int(self.auth.attempts) if self.auth.attempts else 2
 
     @property
-    def _variables(self) -> Template:
-        return self.render_data(self.serialize()["auth"]["variables"])
-
-    @property
-    def _cookies(self) -> Template:
-        return self.render_data(self.serialize()["auth"]["cookies"])
-
-    @property
-    def _headers(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["auth"]["headers"])
-
-    @property
-    def _query_params(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["auth"]["query_params"])
+    def _token_variable(self) -> str:
+        """The variable where the token is saved, it is the first one of the auth variables"""
+        return list(self.auth.variables.__dict__.keys())[0]
 
-    @property
-    def _data(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["auth"]["data"])
+    def _credentials_key(self, context: FlowContext) -> str:
+        """It identifies the token of the middleware for the rendered credentials,
+        the rooms whose credentials are rendered the same way share the same token
+        """
+        credentials = {
+            "url": self._token_url(context),
+            "headers": self._headers(context) if self.auth.headers else None,
+            "query_params": self._query_params(context) if self.auth.query_params else None,
+            "data": self._data(context) if self.auth.data else None,
+        }
+        digest = sha256(dumps(credentials, sort_keys=True, default=str).encode("utf-8"))
+        return f"{self.id}:{digest.hexdigest()}"
+
+    def _token_expires_at(self, token: str, response_data: Any) -> float | None:
+        """It calculates when the token expires
 
-    @property
-    def _basic_auth(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["auth"]["basic_auth"])
+        Parameters
+        ----------
+        token : str
+            The token obtained from the auth response.
+        response_data : Any
+            The data of the auth response.
 
-    @property
-    def _general_headers(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["general"]["headers"])
+        Returns
+        -------
+            The timestamp when the token expires or None if it is unknown.
 
-    async def auth_request(self, session: ClientSession) -> Tuple[int, str]:
+        """
+        if self._expires_in_path and isinstance(response_data, (dict, list)):
+            try:
+                return time() + float(self._expires_in_path.resolve(response_data))
+            except (KeyError, TypeError, ValueError):
+                self.log.warning(f"middleware: {self.id} has no valid {self.auth.expires_in}")
+
+        # The payload of a JWT is the second segment, it is base64url encoded without padding
+        segments = str(token).split(".")
+        if len(segments) == 3:
+            try:
+                payload = segments[1] + "=" * (-len(segments[1]) % 4)
+                exp = loads(base64.urlsafe_b64decode(payload)).get("exp")
+                if isinstance(exp, (int, float)):
+                    return float(exp)
+            except (binascii.Error, UnicodeDecodeError, ValueError, AttributeError):
+                pass
+
+        if self.auth.token_ttl:
+            return time() + float(self.auth.token_ttl)
+
+    def _cookies(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["cookies"], context)
+
+    def _headers(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["headers"], context)
+
+    def _query_params(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["query_params"], context)
+
+    def _data(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["data"], context)
+
+    def _basic_auth(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["basic_auth"], context)
+
+    def _general_headers(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["general_headers"], context)
+
+    async def auth_request(
+        self, context: FlowContext, session: ClientSession, save_variables: bool = True
+    ) -> Tuple[int, Dict, float | None]:
         """Make the auth request to refresh api token
 
         Parameters
         ----------
+        context : FlowContext
+            The execution that needs the token, the token is saved in its room.
         session : ClientSession
             ClientSession
+        save_variables : bool
+            If the variables are saved in the room, the refreshes made in the background
+            don't save them because the room may be running another event.
 
         Returns
         -------
-            The status code and the response text.
+            The status code, the variables obtained from the response and the timestamp
+            when the token expires, if it is known.
 
         """
 
         request_body = {}
 
         if self.auth.query_params:
-            request_body["params"] = self._query_params
+            request_body["params"] = self._query_params(context)
 
         if self.auth.headers:
-            request_body["headers"] = self._headers
+            request_body["headers"] = self._headers(context)
 
         if self.auth.data:
-            request_body["json"] = self._data
+            request_body["json"] = self._data(context)
+
+        token_url = self._token_url(context)
 
         try:
-            timeout = ClientTimeout(total=self.config["menuflow.timeouts.middlewares"])
-            response = await session.request(
-                self.auth.method, self._token_url, timeout=timeout, **request_body
-            )
+            timeout = ClientTimeout(total=context.config["menuflow.timeouts.middlewares"])
+            async with session.request(
+                self.auth.method, token_url, timeout=timeout, **request_body
+            ) as response:
+                status = response.status
+                cookies = response.cookies
+                body = await read_body(
+                    response, context.config["menuflow.http_client.max_body_size"]
+                )
+                response_data = decode_json(body, response.content_type)
         except Exception as e:
             self.log.exception(f"Error in middleware: {e}")
             return
@@ -163,40 +259,29 @@ class HTTPMiddleware(FlowObject):
         variables = {}
 
         if self.auth.cookies:
-            for cookie in self._cookies:
-                variables[cookie] = response.cookies.output(cookie)
+            for cookie in self._cookies(context):
+                variables[cookie] = cookies.output(cookie)
 
         self.log.debug(
-            f"middleware: {self.id}  type: {self.type} method: {self.auth.method} url: {self._token_url} status: {response.status}"
+            f"middleware: {self.id}  type: {self.type} method: {self.auth.method} url: {token_url} status: {status}"
         )
 
-        try:
-            response_data = await response.json()
-        except ContentTypeError:
-            response_data = {}
-
-        if isinstance(response_data, dict):
-            # Tulir and its magic since time immemorial
-            serialized_data = RecursiveDict(CommentedMap(**response_data))
-            if self._variables:
-                for variable in self._variables:
-                    try:
-                        variables[variable] = self.render_data(
-                            serialized_data[self._variables[variable]]
-                        )
-                    except KeyError:
-                        pass
+        if isinstance(response_data, (dict, list)):
+            for variable, path in self._variable_paths.items():
+                try:
+                    variables[variable] = typed_value(path.resolve(response_data))
+                except KeyError:
+                    pass
         elif isinstance(response_data, str):
-            if self._variables:
-                for variable in self._variables:
-                    try:
-                        variables[variable] = self.render_data(response_data)
-                    except KeyError:
-                        pass
+            for variable in self._variable_paths:
+                variables[variable] = typed_value(response_data)
+                break
 
-                    break
+        if variables and save_variables:
+            await context.room.set_variables(variables=variables)
 
-        if variables:
-            await self.room.set_variables(variables=variables)
+        expires_at = None
+        if variables.get(self._token_variable):
+            expires_at = self._token_expires_at(variables[self._token_variable], response_data)
 
-        return response.status, await response.text()
+        return status, variables, expires_at
@@ -2,4 +2,6 @@ from .flow_object import FlowObject
 from .http_request import HTTPRequest
 from .input import Input
 from .message import Message
+from .parallel_request import ParallelRequest
 from .switch import Switch
+from .webhook import Webhook
@@ -1,15 +1,73 @@
 from __future__ import annotations
 
-from json import JSONDecodeError, dumps, loads
-from typing import Any, Dict, List
+from collections import ChainMap
+from functools import partial
+from json import JSONDecodeError, loads
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Tuple
 
 from attr import dataclass, ib
+from jinja2 import Template
 from mautrix.types import SerializableAttrs
 
 from ..config import Config
-from ..jinja.jinja_template import jinja_env
+from ..jinja.jinja_template import DataTemplate, get_template, jinja_env, render
 from ..room import Room
 from ..utils.base_logger import BaseLogger
+from ..utils.json_path import convert_to_bool
+
+
+@dataclass
+class FlowContext:
+    """
+    ## FlowContext
+
+    The nodes of a flow are built once, when the flow is loaded, and they are shared by all
+    the rooms, so they must not be modified. Everything that belongs to a single execution
+    of the flow in a room travels in a FlowContext instead.
+
+    The templates are rendered with a view of the flow variables, the room variables and the
+    jinja globals, in that order of precedence, that doesn't copy them. The rendered fields
+    are kept until a variable of the room changes, so each one is rendered once.
+    """
+
+    room: Room
+    config: Config = None
+    flow_variables: Dict[str, Any] = ib(factory=dict)
+    _variables: ChainMap | None = ib(default=None, init=False)
+    _rendered: Dict[Hashable, Tuple[int, Any]] = ib(factory=dict, init=False)
+
+    @property
+    def variables(self) -> ChainMap:
+        room_variables = self.room._variables
+        # The variables of the room are replaced by a new dict when they are cleared
+        if self._variables is None or self._variables.maps[1] is not room_variables:
+            self._variables = ChainMap(self.flow_variables, room_variables, jinja_env.globals)
+        return self._variables
+
+    def render(self, key: Hashable, render: Callable[[Mapping[str, Any]], Any]) -> Any:
+        """It renders a field, unless it has been rendered since the last change of the
+        variables of the room, in that case the same result is returned
+
+        Parameters
+        ----------
+        key : Hashable
+            The key that identifies the field.
+        render : Callable[[Mapping[str, Any]], Any]
+            The function that renders the field with the variables.
+
+        Returns
+        -------
+            The rendered field, it is shared by the nodes so it must not be modified.
+
+        """
+        version = self.room.variables_version
+        rendered = self._rendered.get(key)
+        if rendered is not None and rendered[0] == version:
+            return rendered[1]
+
+        value = render(self.variables)
+        self._rendered[key] = (version, value)
+        return value
 
 
 @dataclass
@@ -17,67 +75,62 @@ class FlowObject(SerializableAttrs, BaseLogger):
     id: str = ib(metadata={"json": "id"})
     type: str = ib(metadata={"json": "type"})
 
-    room: Room = None
-    config: Config = None
-    flow_variables: Dict[str, Any] = {}
+    def __attrs_post_init__(self) -> None:
+        # The subclasses that prepare something when the flow is loaded extend it
+        pass
+
+    def render_template(self, template: DataTemplate, context: FlowContext) -> Any:
+        """It renders a dict or list compiled when the flow was loaded
+
+        Parameters
+        ----------
+        template : DataTemplate
+            The compiled data.
+        context : FlowContext
+            The execution whose room and flow variables are used to render the data.
+
+        Returns
+        -------
+            The rendered data, it must not be modified.
+
+        """
 
-    def build_node(self):
-        return self.deserialize(self.__dict__)
+        return context.render(template, template.render)
 
-    def render_data(self, data: Dict | List | str) -> Dict | List | str:
-        """It takes a dictionary or list, converts it to a string,
-        and then uses Jinja to render the string
+    def render_data(self, data: Dict | List | str, context: FlowContext) -> Dict | List | str:
+        """It renders a string with Jinja, the result is decoded if it is JSON,
+        the strings of a dictionary or list are rendered one by one
 
         Parameters
         ----------
-        data : Dict | List
+        data : Dict | List | str
             The data to be rendered.
+        context : FlowContext
+            The execution whose room and flow variables are used to render the data.
 
         Returns
         -------
-            A dictionary or list.
+            The rendered string, dictionary or list.
 
         """
 
-        variables: Dict[str, Any] = {}
-        variables.update(self.room._variables)
-        if self.flow_variables:
-            variables.update(self.flow_variables.__dict__)
-
-        if isinstance(data, str):
-            data_template = jinja_env.from_string(data)
-        else:
+        if not isinstance(data, str):
             try:
-                data_template = jinja_env.from_string(dumps(data))
+                return DataTemplate(data).render(context.variables)
             except Exception as e:
                 self.log.exception(e)
                 return
 
-        def convert_to_bool(item):
-            if isinstance(item, dict):
-                for k, v in item.items():
-                    item[k] = convert_to_bool(v)
-                return item
-            elif isinstance(item, list):
-                return [convert_to_bool(i) for i in item]
-            elif isinstance(item, str):
-                if item in ["True", "true"]:
-                    return True
-                elif item in ["False", "false"]:
-                    return False
-                else:
-                    return item
-            else:
-                return item
+        return context.render(data, partial(self._render_string, get_template(data)))
 
+    @staticmethod
+    def _render_string(data_template: Template, variables: Mapping[str, Any]) -> Any:
         try:
-            data = loads(data_template.render(**variables))
-            data = convert_to_bool(data)
-            return data
-        except JSONDecodeError:
-            data = data_template.render(**variables)
-            return convert_to_bool(data)
+            rendered = render(data_template, variables)
         except KeyError:
-            data = loads(data_template.render())
-            data = convert_to_bool(data)
-            return data
+            rendered = data_template.render()
+
+        try:
+            return convert_to_bool(loads(rendered))
+        except JSONDecodeError:
+            return convert_to_bool(rendered)
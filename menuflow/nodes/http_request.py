@@ -1,20 +1,39 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+from functools import partial
+from hashlib import sha256
+from json import dumps
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Tuple
 
 from aiohttp import BasicAuth, ClientSession, ClientTimeout
-from aiohttp.client_exceptions import ContentTypeError
 from attr import dataclass, ib
 from jinja2 import Template
-from mautrix.util.config import RecursiveDict
-from ruamel.yaml.comments import CommentedMap
+from mautrix.types import SerializableAttrs
 
 from ..db.room import RoomState
+from ..http_pool import http_pool
+from ..jinja.jinja_template import DataTemplate
+from ..response_cache import CachedResponse, response_cache
+from ..upstreams import CircuitOpenError, upstreams
+from ..utils.json_path import JSONPath, typed_value
+from ..utils.response_body import decode_json, read_body
+from .flow_object import FlowContext
 from .switch import Case, Switch
 
 if TYPE_CHECKING:
     from middlewares.http import HTTPMiddleware
 
+CONTEXT_PARAMS = DataTemplate(
+    {"bot_mxid": "{{bot_mxid}}", "customer_room_id": "{{customer_room_id}}"}
+)
+
+
+@dataclass
+class HTTPCache(SerializableAttrs):
+    ttl: int = ib(default=60, metadata={"json": "ttl"})
+    stale_while_revalidate: int = ib(default=0, metadata={"json": "stale_while_revalidate"})
+    headers: List[str] = ib(metadata={"json": "headers"}, factory=list)
+
 
 @dataclass
 class HTTPRequest(Switch):
@@ -35,6 +54,17 @@ class HTTPRequest(Switch):
       variables:
         news: data
 
+      # Optional, only for GET and HEAD requests, the successful responses are reused by all
+      # the rooms during ttl seconds, unless the Cache-Control of the response says otherwise.
+      # A stale response is still used during stale_while_revalidate seconds while it is
+      # refreshed in the background. The requests are identified by the method, URL,
+      # query params, data, credentials and these headers.
+      cache:
+        ttl: 300
+        stale_while_revalidate: 60
+        headers:
+          - accept-language
+
       cases:
         - id: 200
           o_connection: m1
@@ -53,130 +83,319 @@ class HTTPRequest(Switch):
     basic_auth: Dict[str, Any] = ib(metadata={"json": "basic_auth"}, factory=dict)
     data: Dict[str, Any] = ib(metadata={"json": "data"}, factory=dict)
     cases: List[Case] = ib(metadata={"json": "cases"}, factory=list)
+    cache: HTTPCache = ib(default=None, metadata={"json": "cache"})
 
-    @property
-    def _url(self) -> Template:
-        return self.render_data(self.url)
+    def _url(self, context: FlowContext) -> Template:
+        return self.render_data(self.url, context)
 
-    @property
-    def _variables(self) -> Template:
-        return self.render_data(self.serialize()["variables"])
+    def _cookies(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["cookies"], context)
 
-    @property
-    def _cookies(self) -> Template:
-        return self.render_data(self.serialize()["cookies"])
+    def _headers(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["headers"], context)
 
-    @property
-    def _headers(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["headers"])
+    def _auth(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["basic_auth"], context)
+
+    def _query_params(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["query_params"], context)
+
+    def _data(self, context: FlowContext) -> Dict:
+        return self.render_template(self._templates["data"], context)
+
+    def _context_params(self, context: FlowContext) -> Dict:
+        # A new dict, the middleware and the context are added to it
+        return dict(self.render_template(CONTEXT_PARAMS, context))
+
+    def __attrs_post_init__(self) -> None:
+        super().__attrs_post_init__()
+        # The paths of the variables are parsed once, when the flow is loaded
+        variables = (
+            self.variables if isinstance(self.variables, dict) else self.variables.serialize()
+        )
+        self._variable_paths: Dict[str, JSONPath] = {
+            variable: JSONPath(path) for variable, path in (variables or {}).items()
+        }
+        # Only the templated values of the request are rendered in each room
+        serialized = self.serialize()
+        self._templates: Dict[str, DataTemplate] = {
+            field: DataTemplate(serialized.get(field))
+            for field in ("cookies", "headers", "basic_auth", "query_params", "data")
+        }
 
     @property
-    def _auth(self) -> Dict[str, Template]:
-        return self.render_data(self.serialize()["basic_auth"])
+    def _cacheable(self) -> bool:
+        # The other methods change the state of the server, their responses can't be reused
+        return str(self.method).upper() in ("GET", "HEAD")
 
     @property
-    def _query_params(self) -> Dict:
-        return self.render_data(self.serialize()["query_params"])
+    def _cache_ttl(self) -> int:
+        return int(self.cache.ttl) if self.cache.ttl else 60
 
     @property
-    def _data(self) -> Dict:
-        return self.render_data(self.serialize()["data"])
+    def _cache_stale_while_revalidate(self) -> int:
+        return int(self.cache.stale_while_revalidate) if self.cache.stale_while_revalidate else 0
 
     @property
-    def _context_params(self) -> Dict[str, Template]:
-        return self.render_data(
-            {
-                "bot_mxid": "{{bot_mxid}}",
-                "customer_room_id": "{{customer_room_id}}",
+    def _cache_headers(self) -> List[str]:
+        return [str(header).lower() for header in self.cache.headers or []]
+
+    def _request_key(
+        self,
+        url: str,
+        request_body: Dict,
+        context: FlowContext,
+        middleware: HTTPMiddleware,
+        headers: List[str] = None,
+    ) -> str:
+        """It identifies the request by its rendered method, URL, params, data, credentials
+        and headers, if a list of headers is given only those headers are taken into account
+        """
+        request_headers = {
+            header.lower(): value
+            for header, value in request_body.get("headers", {}).items()
+            if headers is None or header.lower() in headers
+        }
+
+        credentials = None
+        if middleware and middleware.type == "jwt":
+            credentials = middleware._credentials_key(context)
+        elif middleware and middleware.type == "basic":
+            credentials = middleware._basic_auth(context)
+
+        request = dumps(
+            [
+                self.method,
+                url,
+                request_body.get("params"),
+                request_body.get("json"),
+                request_body.get("auth"),
+                request_headers,
+                credentials,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return sha256(request.encode("utf-8")).hexdigest()
+
+    async def _fetch(
+        self,
+        url: str,
+        request_body: Dict,
+        context: FlowContext,
+        session: ClientSession,
+        middleware: HTTPMiddleware,
+        cache_key: str = None,
+        background: bool = False,
+    ) -> CachedResponse:
+        """It makes the request and reads the response, if the node has the cache enabled
+        the response is saved with the cache_key, and the request is conditional when
+        there is a cached response that can be validated. The requests made in the
+        background don't change the room, it may be running another event by then.
+        """
+        validators = response_cache.validators(cache_key) if cache_key else None
+        if validators:
+            request_body = {
+                **request_body,
+                "headers": {**request_body.get("headers", {}), **validators},
             }
+
+        request_params_ctx = self._context_params(context)
+        request_params_ctx.update(
+            {"middleware": middleware, "context": context, "background": background}
         )
 
-    async def request(self, session: ClientSession, middleware: HTTPMiddleware) -> Tuple(int, str):
+        timeout = ClientTimeout(total=context.config["menuflow.timeouts.http_request"])
+        async with session.request(
+            self.method,
+            url,
+            **request_body,
+            trace_request_ctx=request_params_ctx,
+            timeout=timeout,
+        ) as response:
+            self.log.debug(
+                f"node: {self.id} method: {self.method} url: {url} status: {response.status}"
+            )
+
+            # The body is read once, with a size limit, and decoded once
+            body = await read_body(response, context.config["menuflow.http_client.max_body_size"])
+            cached_response = CachedResponse(
+                status=response.status,
+                body=body,
+                charset=response.charset,
+                data=decode_json(body, response.content_type),
+                cookies=response.cookies,
+                headers={header.lower(): value for header, value in response.headers.items()},
+            )
+
+        # The server has confirmed that the cached response hasn't changed
+        if validators and cached_response.status == 304:
+            cached_response = (
+                response_cache.revalidated(cache_key, cached_response.headers) or cached_response
+            )
+
+        if cache_key and 200 <= cached_response.status < 300:
+            response_cache.set(
+                cache_key,
+                cached_response,
+                ttl=self._cache_ttl,
+                stale_while_revalidate=self._cache_stale_while_revalidate,
+            )
+
+        return cached_response
+
+    async def fetch(
+        self, context: FlowContext, session: ClientSession, middleware: HTTPMiddleware
+    ) -> CachedResponse:
+        """It renders the request and gets its response, from the cache if it is enabled,
+        through the circuit breaker of its upstream and shared with the identical requests
+        that are in flight
+
+        Parameters
+        ----------
+        context : FlowContext
+            The execution whose variables are used to render the request.
+        session : ClientSession
+            The session used to make the request.
+        middleware : HTTPMiddleware
+            The middleware of the request, if it has one.
+
+        Returns
+        -------
+            The response, it can be shared by several rooms so it must not be modified.
+            The errors of the request are raised.
+
+        """
 
         request_body = {}
 
         if self.query_params:
-            request_body["params"] = self._query_params
+            request_body["params"] = self._query_params(context)
 
         if self.basic_auth:
+            auth = self._auth(context)
             request_body["auth"] = BasicAuth(
-                login=self._auth["login"],
-                password=self._auth["password"],
+                login=auth["login"],
+                password=auth["password"],
             )
 
         if self.headers:
-            request_body["headers"] = self._headers
+            request_body["headers"] = self._headers(context)
 
         if self.data:
-            request_body["json"] = self._data
+            request_body["json"] = self._data(context)
 
-        request_params_ctx = self._context_params
-        request_params_ctx.update({"middleware": middleware})
+        url = self._url(context)
+        cache_key = None
+        if self.cache and self._cacheable:
+            cache_key = self._request_key(
+                url, request_body, context, middleware, headers=self._cache_headers
+            )
 
-        try:
-            timeout = ClientTimeout(total=self.config["menuflow.timeouts.http_request"])
-            response = await session.request(
+        # The request is retried and fails fast according to the policy of its upstream
+        breaker = upstreams.breaker(url, middleware.id if middleware else None)
+
+        def call(background: bool = False) -> Callable[[], Awaitable[CachedResponse]]:
+            return partial(
+                upstreams.call,
+                breaker,
                 self.method,
-                self._url,
-                **request_body,
-                trace_request_ctx=request_params_ctx,
-                timeout=timeout,
+                partial(
+                    self._fetch,
+                    url,
+                    request_body,
+                    context,
+                    session,
+                    middleware,
+                    cache_key=cache_key,
+                    background=background,
+                ),
+                # All the attempts together can't take longer than the timeout of a request
+                deadline=context.config["menuflow.timeouts.http_request"],
             )
-        except Exception as e:
-            self.log.exception(f"Error in http_request node: {e}")
-            o_connection = await self.get_case_by_id(id=str(500))
-            await self.room.update_menu(node_id=o_connection, state=None)
-            return 500, e
 
-        self.log.debug(
-            f"node: {self.id} method: {self.method} url: {self._url} status: {response.status}"
-        )
+        if cache_key:
+            response, fresh = response_cache.get(cache_key)
+            if response and not fresh:
+                response_cache.revalidate(cache_key, call(background=True))
+            if response:
+                return response
 
-        if response.status == 401:
-            return response.status, await response.text()
+        fetch = call()
+        # The identical requests that are made at the same time share the response
+        if self._cacheable:
+            request_key = self._request_key(url, request_body, context, middleware)
+            fetch = partial(http_pool.coalesce, request_key, fetch)
+
+        return await fetch()
+
+    def extract_variables(self, response: CachedResponse, context: FlowContext) -> Dict:
+        """It takes the cookies and the variables of the node from the response
+
+        Parameters
+        ----------
+        response : CachedResponse
+            The response of the request.
+        context : FlowContext
+            The execution whose variables are used to render the variables.
+
+        Returns
+        -------
+            The variables to be saved in the room.
+
+        """
 
         variables = {}
-        o_connection = None
 
-        if self._cookies:
-            for cookie in self._cookies:
+        cookies = self._cookies(context)
+        if cookies:
+            for cookie in cookies:
                 variables[cookie] = response.cookies.output(cookie)
 
-        try:
-            response_data = await response.json()
-        except ContentTypeError:
-            response_data = {}
-
-        if isinstance(response_data, dict):
-            # Tulir and its magic since time immemorial
-            serialized_data = RecursiveDict(CommentedMap(**response_data))
-            if self._variables:
-                for variable in self._variables:
-                    try:
-                        variables[variable] = self.render_data(
-                            serialized_data[self.variables[variable]]
-                        )
-                    except KeyError:
-                        pass
+        response_data = response.data
+
+        if isinstance(response_data, (dict, list)):
+            for variable, path in self._variable_paths.items():
+                try:
+                    variables[variable] = typed_value(path.resolve(response_data))
+                except KeyError:
+                    pass
         elif isinstance(response_data, str):
-            if self._variables:
-                for variable in self._variables:
-                    try:
-                        variables[variable] = self.render_data(response_data)
-                    except KeyError:
-                        pass
+            for variable in self._variable_paths:
+                variables[variable] = typed_value(response_data)
+                break
+
+        return variables
 
-                    break
+    async def request(
+        self, context: FlowContext, session: ClientSession, middleware: HTTPMiddleware
+    ) -> Tuple(int, str):
+        try:
+            response = await self.fetch(context=context, session=session, middleware=middleware)
+        except Exception as e:
+            if isinstance(e, CircuitOpenError):
+                self.log.warning(f"http_request node {self.id} not sent: {e}")
+            else:
+                self.log.exception(f"Error in http_request node: {e}")
+            o_connection = await self.get_case_by_id(id=str(500), context=context)
+            await context.room.update_menu(node_id=o_connection, state=None)
+            return 500, e
+
+        if response.status == 401:
+            return response.status, response.text
+
+        variables = self.extract_variables(response, context)
+        o_connection = None
 
         if self.cases:
-            o_connection = await self.get_case_by_id(id=str(response.status))
+            o_connection = await self.get_case_by_id(id=str(response.status), context=context)
 
         if o_connection:
-            await self.room.update_menu(
+            await context.room.update_menu(
                 node_id=o_connection, state=RoomState.END.value if not self.cases else None
             )
 
         if variables:
-            await self.room.set_variables(variables=variables)
+            await context.room.set_variables(variables=variables)
 
-        return response.status, await response.text()
+        return response.status, response.text
@@ -1,15 +1,18 @@
 from __future__ import annotations
 
-from asyncio import sleep
+from typing import TYPE_CHECKING
 
 from attr import dataclass, ib
 from jinja2 import Template
 from markdown import markdown
-from mautrix.errors.request import MLimitExceeded
-from mautrix.types import Format, MessageType, RoomID, TextMessageEventContent
+from mautrix.types import Format, MessageType, TextMessageEventContent
 
-from ..matrix import MatrixClient
-from .flow_object import FlowObject
+from ..jinja.jinja_template import is_template
+from ..utils.markdown_cache import render_markdown
+from .flow_object import FlowContext, FlowObject
+
+if TYPE_CHECKING:
+    from ..matrix import MatrixClient
 
 
 @dataclass
@@ -33,20 +36,27 @@ class Message(FlowObject):
     text: str = ib(default=None, metadata={"json": "text"})
     o_connection: str = ib(default=None, metadata={"json": "o_connection"})
 
-    @property
-    def _text(self) -> Template:
-        return self.render_data(self.text)
+    def __attrs_post_init__(self) -> None:
+        super().__attrs_post_init__()
+        # The texts without jinja syntax are the same in every room,
+        # so they are converted to HTML once, when the flow is loaded
+        self._static_html: str | None = (
+            markdown(self.text)
+            if isinstance(self.text, str) and self.text and not is_template(self.text)
+            else None
+        )
+
+    def _text(self, context: FlowContext) -> Template:
+        return self.render_data(self.text, context)
 
-    async def show_message(self, room_id: RoomID, client: MatrixClient):
-        """It takes a dictionary of variables, a room ID, and a client,
+    async def show_message(self, context: FlowContext, client: MatrixClient):
+        """It takes the execution context and a client,
         and sends a message to the room with the template rendered with the variables
 
         Parameters
         ----------
-        variables : dict
-            A dictionary of variables to pass to the template.
-        room_id : RoomID
-            The room ID to send the message to.
+        context : FlowContext
+            The execution context, the message is sent to its room.
         client : MatrixClient
             The MatrixClient instance that is running the plugin.
 
@@ -55,17 +65,18 @@ class Message(FlowObject):
             self.log.warning(f"The message {self.id} hasn't been send because the text is empty")
             return
 
+        if self._static_html is None:
+            formatted_body = render_markdown(self._text(context))
+        else:
+            formatted_body = self._static_html
+
         msg_content = TextMessageEventContent(
             msgtype=MessageType.TEXT,
             body=self.text,
             format=Format.HTML,
-            formatted_body=markdown(self._text),
+            formatted_body=formatted_body,
         )
 
-        # A way to handle the error that is thrown when the bot sends too many messages too quickly.
-        try:
-            await client.send_message(room_id=room_id, content=msg_content)
-        except MLimitExceeded as e:
-            self.log.warn(e)
-            await sleep(5)
-            await client.send_message(room_id=room_id, content=msg_content)
+        # The message is sent through the queue of the client, that respects the rate limit
+        # of the homeserver and keeps the order of the messages of the room
+        await client.send_queue.send(room_id=context.room.room_id, content=msg_content)
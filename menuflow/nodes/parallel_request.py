@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+from time import monotonic
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+
+from aiohttp import ClientSession
+from attr import dataclass, ib
+from mautrix.types import JSON
+
+from .flow_object import FlowContext
+from .http_request import HTTPRequest
+from .switch import Case, Switch
+
+if TYPE_CHECKING:
+    from ..middlewares.http import HTTPMiddleware
+
+
+@dataclass
+class ParallelRequest(Switch):
+    """
+    ## ParallelRequest
+
+    A parallel_request node sends several HTTP requests at the same time and waits for all of
+    them, so it takes as long as the slowest request instead of the sum of all of them.
+    Each request is defined like an http_request node, without type nor cases, and saves its
+    own variables, then the room transits to another node according to the result of all the
+    requests: all_ok if all of them got a 2xx status, any_failed if any of them failed or
+    got another status, and timeout if they didn't finish in timeout seconds, in that case
+    the pending requests are cancelled.
+
+    content:
+
+    ```
+    - id: 'p1'
+      type: 'parallel_request'
+      timeout: 5
+
+      requests:
+        - id: 'news'
+          method: 'GET'
+          url: 'https://inshorts.deta.dev/news?category={{category}}'
+          variables:
+            news: data
+
+        - id: 'weather'
+          method: 'GET'
+          url: 'https://weather.foo.com/today'
+          middleware: api_jwt
+          variables:
+            weather: forecast
+
+      cases:
+        - id: all_ok
+          o_connection: m1
+        - id: any_failed
+          o_connection: m2
+        - id: timeout
+          o_connection: m3
+        - id: default
+          o_connection: m2
+    ```
+    """
+
+    timeout: float = ib(default=None, metadata={"json": "timeout"})
+    requests: List[HTTPRequest] = ib(metadata={"json": "requests"}, factory=list)
+    cases: List[Case] = ib(metadata={"json": "cases"}, factory=list)
+
+    @classmethod
+    def deserialize(cls, data: JSON) -> ParallelRequest:
+        # The requests are http_request nodes, their type is not written in the flow
+        requests = [
+            {"type": "http_request", **request} if isinstance(request, dict) else request
+            for request in data.get("requests") or []
+        ]
+        return super().deserialize({**data, "requests": requests})
+
+    def __attrs_post_init__(self) -> None:
+        super().__attrs_post_init__()
+        # The requests are built once as http_request nodes, they are shared by all the rooms
+        self.requests = [
+            request
+            if isinstance(request, HTTPRequest)
+            else HTTPRequest.deserialize(
+                request if isinstance(request, dict) else request.serialize()
+            )
+            for request in self.requests or []
+        ]
+
+    def _timeout(self, context: FlowContext) -> float:
+        return (
+            float(self.timeout)
+            if self.timeout
+            else context.config["menuflow.timeouts.http_request"]
+        )
+
+    async def _request(
+        self,
+        request: HTTPRequest,
+        context: FlowContext,
+        session: ClientSession,
+        middleware: HTTPMiddleware,
+    ) -> Tuple[bool, Dict]:
+        try:
+            response = await request.fetch(context=context, session=session, middleware=middleware)
+        except Exception as e:
+            self.log.warning(f"The request [{request.id}] of the node [{self.id}] failed: {e}")
+            return False, {}
+
+        self.log.debug(f"node: {self.id} request: {request.id} status: {response.status}")
+        return 200 <= response.status < 300, request.extract_variables(response, context)
+
+    async def run(
+        self,
+        context: FlowContext,
+        session: ClientSession,
+        get_middleware: Callable[[str], HTTPMiddleware | None],
+    ) -> str:
+        """It sends all the requests, saves their variables with a single update of the room
+        and returns the connection of the case that matches the result
+
+        Parameters
+        ----------
+        context : FlowContext
+            The execution whose variables are used to render the requests.
+        session : ClientSession
+            The session used to make the requests.
+        get_middleware : Callable[[str], HTTPMiddleware | None]
+            It returns the middleware of a request by its ID.
+
+        Returns
+        -------
+            The connection of the case all_ok, any_failed or timeout.
+
+        """
+
+        start = monotonic()
+        tasks = [
+            asyncio.create_task(
+                self._request(request, context, session, get_middleware(request.middleware))
+            )
+            for request in self.requests
+        ]
+
+        done, pending = set(), set()
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=self._timeout(context))
+        # The requests that haven't finished are cancelled, and with them the shared requests
+        # that no other room is waiting for, so they don't keep holding their connections
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        variables = {}
+        all_ok = True
+        for task in tasks:
+            if task not in done:
+                continue
+
+            ok, request_variables = task.result()
+            all_ok = all_ok and ok
+            variables.update(request_variables)
+
+        if variables:
+            await context.room.set_variables(variables=variables)
+
+        result = "timeout" if pending else "all_ok" if all_ok else "any_failed"
+        self.log.debug(
+            f"node: {self.id} requests: {len(tasks)} result: {result} "
+            f"time: {monotonic() - start:.3f}"
+        )
+        return await self.get_case_by_id(result, context)
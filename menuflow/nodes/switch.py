@@ -1,9 +1,17 @@
-from typing import Any, Dict, List
+from __future__ import annotations
+
+import re
+from json import JSONDecodeError, loads
+from typing import Any, Dict, List, Mapping, Pattern, Tuple
 
 from attr import dataclass, ib
+from jinja2 import Template
+from markupsafe import escape
 from mautrix.types import SerializableAttrs
 
-from .flow_object import FlowObject
+from ..jinja.jinja_template import compile_expression, evaluate
+from ..utils.json_path import convert_to_bool
+from .flow_object import FlowContext, FlowObject
 
 
 @dataclass
@@ -11,6 +19,8 @@ class Case(SerializableAttrs):
     id: str = ib(metadata={"json": "id"})
     variables: Dict[str, Any] = ib(metadata={"json": "variables"}, factory=dict)
     o_connection: str = ib(default=None, metadata={"json": "o_connection"})
+    range: List[float] = ib(default=None, metadata={"json": "range"})
+    regex: str = ib(default=None, metadata={"json": "regex"})
 
 
 @dataclass
@@ -35,44 +45,115 @@ class Switch(FlowObject):
       - id: default
         o_connection: m3
     ```
+
+    Besides the exact value, a case can match a numeric range (both ends included)
+    or a regular expression that must match the whole value. The exact cases are
+    checked first, then the ranges and then the regular expressions, in their order.
+
+    ```
+      cases:
+      - id: young
+        range: [0, 17]
+        o_connection: m4
+      - id: email
+        regex: '[^@]+@[^@]+'
+        o_connection: m5
+    ```
     """
 
     validation: str = ib(default=None, metadata={"json": "validation"})
     cases: List[Case] = ib(metadata={"json": "cases"}, factory=list)
 
-    async def load_cases(self) -> Dict[str, str]:
-        """It loads the cases into a dictionary.
+    def __attrs_post_init__(self) -> None:
+        super().__attrs_post_init__()
+        # The validation and the cases are compiled once, when the flow is loaded
+        self._validation: Template | None = (
+            compile_expression(self.validation) if isinstance(self.validation, str) else None
+        )
+        self._cases_by_id: Dict[str, Dict] = {}
+        self._range_cases: List[Tuple[float, float, str]] = []
+        self._regex_cases: List[Tuple[Pattern, str]] = []
+        for case in self.cases or []:
+            case_id = str(case.id)
+            variables = getattr(case, "variables", None) or {}
+            self._cases_by_id[case_id] = {
+                "o_connection": case.o_connection,
+                "variables": variables if isinstance(variables, dict) else variables.__dict__,
+            }
+
+            case_range = getattr(case, "range", None)
+            if case_range:
+                try:
+                    start, end = (float(limit) for limit in case_range)
+                    self._range_cases.append((start, end, case_id))
+                except (TypeError, ValueError):
+                    self.log.warning(f"The case [{case_id}] of [{self.id}] has an invalid range")
+
+            case_regex = getattr(case, "regex", None)
+            if case_regex:
+                try:
+                    self._regex_cases.append((re.compile(str(case_regex)), case_id))
+                except re.error as e:
+                    self.log.warning(
+                        f"The case [{case_id}] of [{self.id}] has an invalid regex: {e}"
+                    )
 
-        Parameters
-        ----------
-        room : Room
-            Room = None
+    async def load_cases(self) -> Dict[str, Dict]:
+        """It returns the cases by ID, they are built when the flow is loaded
 
         Returns
         -------
-            A dictionary of cases.
+            A dictionary of cases, it must not be modified.
 
         """
 
-        cases_dict = {}
+        return self._cases_by_id
+
+    def _match_case(self, id: str) -> str:
+        """It returns the ID of the case that matches the result of the validation"""
+        if id in self._cases_by_id:
+            return id
+
+        if self._range_cases:
+            try:
+                number = float(id)
+            except ValueError:
+                pass
+            else:
+                for start, end, case_id in self._range_cases:
+                    if start <= number <= end:
+                        return case_id
+
+        for regex, case_id in self._regex_cases:
+            if regex.fullmatch(id):
+                return case_id
+
+        return id
+
+    def _evaluate(self, variables: Mapping[str, Any]) -> Any:
+        result = evaluate(self._validation, variables)
+        # The value becomes the text the validation would render, escaped like the templates,
+        # so it gets the same result as when the validation was rendered
+        if self._validation.environment.autoescape:
+            result = escape(result)
+        try:
+            return convert_to_bool(loads(str(result)))
+        except JSONDecodeError:
+            return convert_to_bool(str(result))
 
-        for case in self.cases:
-            cases_dict[str(case.id)] = {
-                "o_connection": case.o_connection,
-                "variables": case.variables
-                if isinstance(case.variables, dict)
-                else case.variables.__dict__,
-            }
-        return cases_dict
+    def _validate(self, context: FlowContext) -> Any:
+        if self._validation is None:
+            return self.render_data(self.validation, context)
+        return context.render(self._validation, self._evaluate)
 
-    async def run(self) -> str:
-        """It takes a dictionary of variables, runs the rule,
+    async def run(self, context: FlowContext) -> str:
+        """It takes the execution context, runs the rule,
         and returns the connection that matches the case
 
         Parameters
         ----------
-        variables : dict
-            dict
+        context : FlowContext
+            The execution whose variables are used to run the rule.
 
         Returns
         -------
@@ -80,12 +161,14 @@ class Switch(FlowObject):
 
         """
 
-        self.log.debug(f"Executing validation of input [{self.id}] for room [{self.room.room_id}]")
+        self.log.debug(
+            f"Executing validation of input [{self.id}] for room [{context.room.room_id}]"
+        )
 
         result = None
 
         try:
-            result = self.render_data(self.validation)
+            result = self._validate(context)
             # TODO What would be the best way to handle this, taking jinja into account?
             # if res == "True":
             #     res = True
@@ -97,24 +180,23 @@ class Switch(FlowObject):
             self.log.warning(f"An exception has occurred in the pipeline [{self.id} ]:: {e}")
             result = "except"
 
-        return await self.get_case_by_id(str(result))
+        return await self.get_case_by_id(str(result), context)
 
-    async def get_case_by_id(self, id: str) -> str:
+    async def get_case_by_id(self, id: str, context: FlowContext) -> str:
         try:
-            cases = await self.load_cases()
-            case_result = cases[id]
+            cases = self._cases_by_id
+            case_result = cases[self._match_case(id)]
 
             variables_recorded = []
 
-            if case_result.get("variables") and self.room:
-
+            if case_result.get("variables"):
                 for variable in case_result.get("variables", {}):
                     if variable in variables_recorded:
                         continue
 
-                    await self.room.set_variable(
+                    await context.room.set_variable(
                         variable_id=variable,
-                        value=self.render_data(case_result["variables"][variable]),
+                        value=self.render_data(case_result["variables"][variable], context),
                     )
                     variables_recorded.append(variable)
 
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from typing import Any, Dict
+
+from attr import dataclass, ib
+
+from ..webhooks import webhook_queue
+from .flow_object import FlowContext
+from .http_request import HTTPRequest
+
+
+@dataclass
+class Webhook(HTTPRequest):
+    """
+    ## Webhook
+
+    A webhook node sends a request whose response is not needed, like a notification to a CRM.
+    The request is rendered with the variables of the room and queued to be sent in the
+    background, so the room goes on to the next node immediately. The failed requests are
+    retried and the queued ones survive the restarts.
+
+    The request is defined like in an http_request node, middlewares are not supported
+    because the request can be sent after the execution of the room has finished.
+
+    content:
+
+    ```
+    - id: 'w1'
+      type: 'webhook'
+      method: 'POST'
+      url: 'https://crm.foo.com/api/events'
+      headers:
+        x-api-key: 'secretfoo'
+      data:
+        customer: '{{customer_room_id}}'
+        option: '{{opt}}'
+      o_connection: m2
+    ```
+    """
+
+    o_connection: str = ib(default=None, metadata={"json": "o_connection"})
+
+    def _request(self, context: FlowContext) -> Dict[str, Any]:
+        request = {"method": self.method, "url": self._url(context)}
+
+        if self.query_params:
+            request["params"] = self._query_params(context)
+
+        if self.headers:
+            request["headers"] = self._headers(context)
+
+        if self.data:
+            request["json"] = self._data(context)
+
+        if self.basic_auth:
+            request["basic_auth"] = self._auth(context)
+
+        return request
+
+    async def run(self, context: FlowContext) -> bool:
+        """It renders the request and queues it
+
+        Parameters
+        ----------
+        context : FlowContext
+            The execution whose variables are used to render the request.
+
+        Returns
+        -------
+            False if the request has been dropped because the queue is full.
+
+        """
+        return await webhook_queue.enqueue(self._request(context))
@@ -0,0 +1,397 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import sqlite3
+from base64 import b64decode, b64encode
+from http.cookies import SimpleCookie
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Mapping, Set, Tuple
+
+from attr import dataclass, ib
+from mautrix.util.logging import TraceLogger
+
+from .config import Config
+from .utils.lru_cache import LRUCache
+from .utils.single_flight import SingleFlight
+
+
+@dataclass
+class CachedResponse:
+    """The parts of an HTTP response used by the http_request nodes,
+    they are read once so the response can be shared and cached.
+    """
+
+    status: int
+    body: bytes = b""
+    charset: str = None
+    data: Any = None
+    cookies: SimpleCookie = ib(factory=SimpleCookie)
+    headers: Dict[str, str] = ib(factory=dict)
+    fresh_until: float = 0
+    stale_until: float = 0
+    # It can't be used without asking the server if it has changed, as with no-cache
+    must_revalidate: bool = False
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.charset or "utf-8", errors="replace")
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """The headers that make the request conditional, so the server answers 304
+        without the body if the response hasn't changed
+        """
+        validators = {}
+        if self.headers.get("etag"):
+            validators["If-None-Match"] = self.headers["etag"]
+        if self.headers.get("last-modified"):
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+    def serialize(self) -> Dict[str, Any]:
+        """The response as a JSON document, to be saved in the store"""
+        return {
+            "status": self.status,
+            "body": b64encode(self.body).decode("ascii"),
+            "charset": self.charset,
+            "data": self.data,
+            "cookies": [morsel.OutputString() for morsel in self.cookies.values()],
+            "headers": self.headers,
+            "fresh_until": self.fresh_until,
+            "stale_until": self.stale_until,
+            "must_revalidate": self.must_revalidate,
+        }
+
+    @classmethod
+    def deserialize(cls, data: Dict[str, Any]) -> CachedResponse:
+        cookies = SimpleCookie()
+        for cookie in data.get("cookies") or []:
+            cookies.load(cookie)
+        return cls(
+            status=data["status"],
+            body=b64decode(data["body"]),
+            charset=data.get("charset"),
+            data=data.get("data"),
+            cookies=cookies,
+            headers=data.get("headers") or {},
+            fresh_until=data["fresh_until"],
+            stale_until=data["stale_until"],
+            must_revalidate=data.get("must_revalidate", False),
+        )
+
+    def revalidated(self, headers: Dict[str, str]) -> CachedResponse:
+        """The response updated with the headers of the 304 that confirmed it
+
+        Parameters
+        ----------
+        headers : Dict[str, str]
+            The headers of the 304 response, with lowercase names.
+
+        Returns
+        -------
+            A new response, the cached one can be in use by other rooms.
+
+        """
+        return CachedResponse(
+            status=self.status,
+            body=self.body,
+            charset=self.charset,
+            data=self.data,
+            cookies=self.cookies,
+            headers={**self.headers, **headers},
+        )
+
+
+def parse_cache_control(headers: Mapping[str, str]) -> Dict[str, str | None]:
+    """It parses the Cache-Control header of a response
+
+    Parameters
+    ----------
+    headers : Mapping[str, str]
+        The headers of the response, with lowercase names.
+
+    Returns
+    -------
+        The directives of the header, the ones without value are mapped to None.
+
+    """
+    directives = {}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+class ResponseCache:
+    """The responses of the http_request nodes that enable the cache.
+
+    The responses are kept in a bounded LRU cache and, optionally, in a local SQLite store
+    to survive the restarts, as JSON. The store is read once, when the cache is initialized,
+    and the changes are written to it behind, in a thread, so the rooms never wait for the
+    disk. The responses evicted from the cache or expired are removed from the store too.
+    A stale response is still used during the stale_while_revalidate seconds after it
+    expires while a single request refreshes it in the background.
+    """
+
+    log: TraceLogger = logging.getLogger("menuflow.response_cache")
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.responses = LRUCache(maxsize=maxsize)
+        self.store: sqlite3.Connection | None = None
+        # The changes that haven't been written to the store yet, None removes the response
+        self._pending_writes: Dict[str, CachedResponse | None] = {}
+        self._write_task: asyncio.Task | None = None
+        self._revalidations = SingleFlight()
+        self._background_revalidations: Set[asyncio.Task] = set()
+        self.fresh_hits = 0
+        self.stale_hits = 0
+        self.stored = 0
+        self.not_stored = 0
+
+    def init(self, config: Config) -> None:
+        self.responses.maxsize = config["menuflow.cache.responses"]
+        if config["menuflow.cache.responses_store"]:
+            try:
+                self.store = sqlite3.connect(
+                    config["menuflow.cache.responses_store"], check_same_thread=False
+                )
+                self.store.execute(
+                    "CREATE TABLE IF NOT EXISTS response "
+                    "(key TEXT PRIMARY KEY, response TEXT NOT NULL, stale_until REAL NOT NULL)"
+                )
+                self._load_store()
+            except sqlite3.Error as e:
+                self.log.warning(f"The response store can't be used, it is disabled: {e}")
+                if self.store is not None:
+                    self.store.close()
+                self.store = None
+
+    def _load_store(self) -> None:
+        """It loads the responses of the store that can still be used or revalidated,
+        the rest are removed from it
+        """
+        with self.store:
+            self.store.execute("DELETE FROM response WHERE stale_until <= ?", (time(),))
+            rows = self.store.execute(
+                "SELECT key, response FROM response ORDER BY stale_until DESC LIMIT ?",
+                (max(self.responses.maxsize, 0),),
+            ).fetchall()
+            # The ones that don't fit in the cache would never be removed from the store
+            self.store.execute(
+                "DELETE FROM response WHERE key NOT IN "
+                "(SELECT key FROM response ORDER BY stale_until DESC LIMIT ?)",
+                (max(self.responses.maxsize, 0),),
+            )
+
+        for key, response in reversed(rows):
+            try:
+                self.responses[key] = CachedResponse.deserialize(json.loads(response))
+            except (ValueError, KeyError, TypeError) as e:
+                self.log.warning(f"The response {key} of the store can't be read: {e}")
+
+        self.log.debug(f"{len(self.responses)} responses loaded from the store")
+
+    def _write_store(self, changes: Dict[str, CachedResponse | None]) -> None:
+        saved = [
+            (key, json.dumps(response.serialize()), response.stale_until)
+            for key, response in changes.items()
+            if response is not None
+        ]
+        removed = [(key,) for key, response in changes.items() if response is None]
+        try:
+            with self.store:
+                self.store.executemany("DELETE FROM response WHERE key = ?", removed)
+                self.store.executemany(
+                    "INSERT OR REPLACE INTO response (key, response, stale_until) "
+                    "VALUES (?, ?, ?)",
+                    saved,
+                )
+                # The responses that have expired while they were in the cache
+                self.store.execute("DELETE FROM response WHERE stale_until <= ?", (time(),))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self.log.warning(f"Error saving the responses in the store: {e}")
+
+    def _schedule_write(self, key: str, response: CachedResponse | None) -> None:
+        """It queues the change of a response to be written to the store,
+        None removes the response from it
+        """
+        if self.store is None:
+            return
+
+        self._pending_writes[key] = response
+        if not self._write_task or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_behind())
+
+    async def _write_behind(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending_writes:
+            changes, self._pending_writes = self._pending_writes, {}
+            await loop.run_in_executor(None, self._write_store, changes)
+
+    async def close(self) -> None:
+        if self.store is None:
+            return
+
+        if self._write_task:
+            await self._write_task
+        await self._write_behind()
+        self.store.close()
+        self.store = None
+
+    def get(self, key: str) -> Tuple[CachedResponse | None, bool]:
+        """It looks for a response that can be used without making the request
+
+        Parameters
+        ----------
+        key : str
+            The key of the request.
+
+        Returns
+        -------
+            The cached response, or None if there isn't a usable one,
+            and whether it is still fresh.
+
+        """
+        response: CachedResponse | None = self.responses.get(key)
+
+        now = time()
+        if response is None or response.must_revalidate or response.stale_until <= now:
+            return None, False
+
+        if response.fresh_until > now:
+            self.fresh_hits += 1
+            return response, True
+
+        self.stale_hits += 1
+        return response, False
+
+    def validators(self, key: str) -> Dict[str, str]:
+        """The headers that make the request conditional on the cached response,
+        it doesn't matter if the response is no longer usable
+
+        Parameters
+        ----------
+        key : str
+            The key of the request.
+
+        Returns
+        -------
+            The headers, empty if there is no response or it can't be validated.
+
+        """
+        response: CachedResponse | None = self.responses.peek(key)
+        return response.validators if response else {}
+
+    def revalidated(self, key: str, headers: Dict[str, str]) -> CachedResponse | None:
+        """The cached response, updated with the headers of the 304 that confirmed it
+
+        Parameters
+        ----------
+        key : str
+            The key of the request.
+        headers : Dict[str, str]
+            The headers of the 304 response, with lowercase names.
+
+        Returns
+        -------
+            The response, or None if it is no longer in the cache.
+
+        """
+        response: CachedResponse | None = self.responses.peek(key)
+        return response.revalidated(headers) if response else None
+
+    def set(self, key: str, response: CachedResponse, ttl: int, stale_while_revalidate: int):
+        """It saves the response, unless its Cache-Control doesn't allow it.
+
+        The cache is shared by all the rooms, so the private responses are not saved.
+        The responses that must be revalidated, with no-cache or without a max-age,
+        are only saved if they can be validated, to make the next request conditional.
+
+        Parameters
+        ----------
+        key : str
+            The key of the request.
+        response : CachedResponse
+            The response to be cached.
+        ttl : int
+            The seconds the response is fresh, the max-age of the response has precedence.
+        stale_while_revalidate : int
+            The seconds a stale response can be used while it is refreshed,
+            the stale-while-revalidate of the response has precedence.
+
+        """
+        cache_control = parse_cache_control(response.headers)
+        if "no-store" in cache_control or "private" in cache_control:
+            self.not_stored += 1
+            return
+
+        # The response is kept at least as long as the node asks, to be revalidated
+        retention = max(ttl, 0) + max(stale_while_revalidate, 0)
+        try:
+            ttl = int(cache_control.get("max-age") or ttl)
+            stale_while_revalidate = int(
+                cache_control.get("stale-while-revalidate") or stale_while_revalidate
+            )
+        except ValueError:
+            pass
+
+        now = time()
+        if "no-cache" in cache_control or ttl <= 0:
+            if not response.validators or retention <= 0:
+                self.not_stored += 1
+                return
+            response.must_revalidate = True
+            response.fresh_until = now
+            response.stale_until = now + retention
+        else:
+            response.fresh_until = now + ttl
+            response.stale_until = response.fresh_until + max(stale_while_revalidate, 0)
+
+        evicted = self.responses.set(key, response)
+        self.stored += 1
+
+        self._schedule_write(key, response)
+        for evicted_key, _ in evicted:
+            self._schedule_write(evicted_key, None)
+
+    def revalidate(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> None:
+        """It refreshes a stale response in the background,
+        only one refresh is made for each key at the same time
+
+        Parameters
+        ----------
+        key : str
+            The key of the request.
+        fetch : Callable[[], Awaitable[Any]]
+            The function that makes the request and saves the new response.
+
+        """
+        if key in self._revalidations:
+            return
+
+        async def revalidate() -> None:
+            try:
+                await self._revalidations.run(key, fetch)
+            except Exception as e:
+                self.log.warning(f"Error revalidating the response {key}: {e}")
+
+        task = asyncio.create_task(revalidate())
+        self._background_revalidations.add(task)
+        task.add_done_callback(self._background_revalidations.discard)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self.responses.stats,
+            "fresh_hits": self.fresh_hits,
+            "stale_hits": self.stale_hits,
+            "revalidations": self._revalidations.calls,
+            "stored": self.stored,
+            "not_stored": self.not_stored,
+        }
+
+
+response_cache = ResponseCache()
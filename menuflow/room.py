@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import asyncio
 import json
 from logging import getLogger
-from typing import Any, Dict, cast
+from typing import Any, Dict, Set, cast
 
 from mautrix.types import RoomID
 from mautrix.util.logging import TraceLogger
@@ -10,10 +11,20 @@ from mautrix.util.logging import TraceLogger
 from .config import Config
 from .db.room import Room as DBRoom
 from .db.room import RoomState
+from .utils.lru_cache import LRUCache
+from .utils.single_flight import SingleFlight
 
 
 class Room(DBRoom):
-    by_room_id: Dict[RoomID, "Room"] = {}
+    by_room_id: LRUCache = LRUCache(maxsize=10000, idle_ttl=3600)
+    # Rooms evicted from the cache with unsaved changes, they are kept until they are saved
+    # so that they are not loaded again from the database with stale data
+    _evicted_rooms: Dict[RoomID, "Room"] = {}
+
+    # Seconds that a change can wait in memory before being saved in the database
+    flush_deadline: float = 2
+    _flush_tasks: Set[asyncio.Task] = set()
+    _get_flights: SingleFlight = SingleFlight()
 
     config: Config
     log: TraceLogger = getLogger("menuflow.room")
@@ -26,23 +37,127 @@ class Room(DBRoom):
         id: int = None,
         variables: str = "{}",
     ) -> None:
-        self._variables: Dict = json.loads(variables)
-        super().__init__(
-            id=id, room_id=room_id, node_id=node_id, state=state, variables=f"{variables}"
-        )
+        self._variables: Dict = {}
+        super().__init__(id=id, room_id=room_id, node_id=node_id, state=state, variables=variables)
         self.log = self.log.getChild(self.room_id)
+        self._dirty = False
+        self._changed_variables: Set[str] = set()
+        self._variables_version = 0
+        self._flush_handle: asyncio.TimerHandle | None = None
+        # Only one flush of the room writes at the same time, clean_up waits for it
+        self._flush_lock = asyncio.Lock()
+
+    @classmethod
+    def init_cls(cls, config: Config) -> None:
+        cls.flush_deadline = config["menuflow.room_state.flush_deadline"]
+        cls.by_room_id.maxsize = config["menuflow.cache.rooms"]
+        cls.by_room_id.idle_ttl = config["menuflow.cache.idle_ttl"]
 
     def _add_to_cache(self) -> None:
         if self.room_id:
-            self.by_room_id[self.room_id] = self
+            for _, room in self.by_room_id.set(self.room_id, self):
+                room._on_evict()
+
+    def _on_evict(self) -> None:
+        if not self._dirty:
+            return
+
+        self.log.debug(f"The room [{self.room_id}] was evicted with unsaved changes, saving ...")
+        self._evicted_rooms[self.room_id] = self
+        self._cancel_flush()
+        self._flush_in_background()
+
+    def _mark_dirty(self) -> None:
+        """It marks the room as changed, the changes will be saved by the next flush,
+        which is done at the end of the event processing or when the flush deadline expires.
+        """
+        self._dirty = True
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_deadline, self._flush_in_background
+            )
+
+    def _cancel_flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _flush_in_background(self) -> None:
+        self._flush_handle = None
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    @property
+    def variables(self) -> str:
+        """The variables of the room serialized for the database, they are kept as a dict"""
+        return json.dumps(self._variables)
+
+    @variables.setter
+    def variables(self, variables: str | Dict | None) -> None:
+        self._variables = (
+            json.loads(variables) if isinstance(variables, str) else dict(variables or {})
+        )
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    @property
+    def variables_version(self) -> int:
+        """A number that changes every time a variable of the room is set"""
+        return self._variables_version
+
+    async def flush(self) -> None:
+        """It saves the pending changes of the room in the database with a single UPDATE"""
+        self._cancel_flush()
+
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            self._dirty = False
+            changed_variables = self._changed_variables
+            self._changed_variables = set()
+
+            try:
+                await self.update_changes(
+                    variables={
+                        variable_id: self._variables[variable_id]
+                        for variable_id in changed_variables
+                    }
+                )
+            except Exception as e:
+                self.log.exception(f"Error saving the room [{self.room_id}]: {e}")
+                self._changed_variables |= changed_variables
+                self._mark_dirty()
+                return
+
+        if not self._dirty and self._evicted_rooms.get(self.room_id) is self:
+            del self._evicted_rooms[self.room_id]
+
+    @classmethod
+    async def flush_all(cls) -> None:
+        """It saves the pending changes of all the rooms, it is used on shutdown"""
+        rooms = [*cls.by_room_id.values(), *cls._evicted_rooms.values()]
+        await asyncio.gather(*(room.flush() for room in rooms))
 
     async def clean_up(self):
-        del self.by_room_id[self.room_id]
-        self.variables = "{}"
-        self._variables = "{}"
-        self.node_id = RoomState.START.value
-        self.state = None
-        await self.update()
+        self.by_room_id.pop(self.room_id)
+        self._evicted_rooms.pop(self.room_id, None)
+
+        # A flush that is already writing would merge the old variables after the reset,
+        # so it is awaited, and the ones that come later find nothing to save
+        async with self._flush_lock:
+            self._cancel_flush()
+            self._dirty = False
+            self._changed_variables = set()
+            self._variables_version += 1
+            self._variables = {}
+            self.node_id = RoomState.START.value
+            self.state = None
+            await self.update()
 
     @classmethod
     async def get_by_room_id(cls, room_id: RoomID, create: bool = True) -> "Room" | None:
@@ -65,19 +180,30 @@ class Room(DBRoom):
         except KeyError:
             pass
 
-        room = cast(cls, await super().get_by_room_id(room_id))
+        # Concurrent events of the same room share a single database round trip
+        return await cls._get_flights.run(
+            (room_id, create), lambda: cls._load_by_room_id(room_id, create)
+        )
+
+    @classmethod
+    async def _load_by_room_id(cls, room_id: RoomID, create: bool) -> "Room" | None:
+        if room_id in cls.by_room_id:
+            return cls.by_room_id[room_id]
 
+        room = cls._evicted_rooms.pop(room_id, None)
         if room is not None:
             room._add_to_cache()
             return room
 
         if create:
-
-            room = cls(room_id=room_id, node_id=RoomState.START.value)
-            await room.insert()
+            room = cast(cls, await super().get_or_create(room_id, RoomState.START.value))
+        else:
             room = cast(cls, await super().get_by_room_id(room_id))
+
+        if room is not None:
             room._add_to_cache()
-            return room
+
+        return room
 
     async def get_variable(self, variable_id: str) -> Any | None:
         """This function returns the value of a variable with the given ID
@@ -96,11 +222,12 @@ class Room(DBRoom):
 
     async def set_variable(self, variable_id: str, value: Any):
         self._variables[variable_id] = value
-        self.variables = json.dumps(self._variables)
+        self._changed_variables.add(variable_id)
+        self._variables_version += 1
         self.log.debug(
             f"Saving variable [{variable_id}] to room [{self.room_id}] :: content [{value}]"
         )
-        await self.update()
+        self._mark_dirty()
 
     async def set_variables(self, variables: Dict):
         """It takes a dictionary of variable IDs and values, and sets the variables to the values
@@ -131,5 +258,5 @@ class Room(DBRoom):
         )
         self.node_id = node_id.value if isinstance(node_id, RoomState) else node_id
         self.state = state.value if isinstance(state, RoomState) else state
-        await self.update()
+        self._mark_dirty()
         self._add_to_cache()
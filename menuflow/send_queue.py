@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import deque
+from contextvars import ContextVar
+from time import monotonic
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Deque, Dict
+
+from aiohttp import ClientSession, TraceConfig, TraceRequestEndParams
+from mautrix.errors.request import MLimitExceeded
+from mautrix.types import EventID, RoomID
+from mautrix.util.logging import TraceLogger
+
+from .utils.token_bucket import TokenBucket
+
+# The time to wait that the homeserver sent with its last M_LIMIT_EXCEEDED error,
+# mautrix doesn't keep it in the exception so it is taken from the response by a trace hook
+_retry_after: ContextVar[float | None] = ContextVar("retry_after", default=None)
+
+
+async def _record_retry_after(
+    _: ClientSession, __: SimpleNamespace, params: TraceRequestEndParams
+) -> None:
+    response = params.response
+    if response.status != 429:
+        return
+
+    retry_after = None
+    try:
+        retry_after = float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        try:
+            retry_after = (await response.json(content_type=None))["retry_after_ms"] / 1000
+        except Exception:
+            pass
+    _retry_after.set(retry_after)
+
+
+def rate_limit_trace() -> TraceConfig:
+    """The trace config that must be added to the sessions of the clients,
+    so the send queues know how much time the homeserver asks them to wait
+    """
+    trace_config = TraceConfig()
+    trace_config.on_request_end.append(_record_retry_after)
+    return trace_config
+
+
+class OutboundMessage:
+    def __init__(self, content: Any) -> None:
+        self.content = content
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.queued_at = monotonic()
+        self.attempts = 0
+
+
+class SendQueue:
+    """The outbound messages of a client, they are sent at the rate allowed by the homeserver.
+
+    The messages of a room are sent in order, one at a time, and the rooms with pending
+    messages take turns to send, so a room that sends many messages can't delay the others.
+    When the homeserver rejects a message because of its rate limit, the queue waits the
+    time that it asks before sending again. The task that sends the messages only lives
+    while there are messages in the queue.
+    """
+
+    log: TraceLogger = logging.getLogger("menuflow.send_queue")
+
+    def __init__(
+        self,
+        send: Callable[[RoomID, Any], Awaitable[EventID]],
+        rate: float = 10,
+        burst: int = 20,
+        max_retries: int = 5,
+        retry_after: float = 5,
+    ) -> None:
+        self._send = send
+        self.max_retries = max_retries
+        # The time to wait when the homeserver doesn't say it
+        self.retry_after = retry_after
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.rooms: Dict[RoomID, Deque[OutboundMessage]] = {}
+        # The rooms with pending messages, in the order they will send
+        self._turns: Deque[RoomID] = deque()
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    async def send(self, room_id: RoomID, content: Any) -> EventID:
+        """It queues a message and waits until it is sent
+
+        Parameters
+        ----------
+        room_id : RoomID
+            The room the message is sent to.
+        content : Any
+            The content of the message.
+
+        Returns
+        -------
+            The ID of the event of the message, the error is raised if it couldn't be sent.
+
+        """
+        message = OutboundMessage(content)
+        try:
+            self.rooms[room_id].append(message)
+        except KeyError:
+            self.rooms[room_id] = deque([message])
+            self._turns.append(room_id)
+
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        return await message.future
+
+    async def _run(self) -> None:
+        while self._turns:
+            room_id = self._turns.popleft()
+            messages = self.rooms[room_id]
+            try:
+                await self._send_next(room_id, messages)
+            except Exception as e:
+                self.log.exception(f"Error sending a message to {room_id}: {e}")
+
+            if messages:
+                self._turns.append(room_id)
+            else:
+                del self.rooms[room_id]
+
+    async def _send_next(self, room_id: RoomID, messages: Deque[OutboundMessage]) -> None:
+        message = messages[0]
+        # The caller has been cancelled, there is no one waiting for the message
+        if message.future.done():
+            messages.popleft()
+            return
+
+        await self.bucket.acquire()
+        message.attempts += 1
+        _retry_after.set(None)
+        try:
+            event_id = await self._send(room_id, message.content)
+        except MLimitExceeded as e:
+            self.rate_limited += 1
+            retry_after = _retry_after.get() or self.retry_after
+            self.log.warning(f"Rate limited sending to {room_id}, waiting {retry_after}s: {e}")
+            self.bucket.pause(retry_after)
+            if message.attempts <= self.max_retries:
+                return
+            self._finish(messages, exception=e)
+        except Exception as e:
+            self._finish(messages, exception=e)
+        else:
+            self._finish(messages, result=event_id)
+
+    def _finish(
+        self, messages: Deque[OutboundMessage], result: Any = None, exception: Exception = None
+    ) -> None:
+        message = messages.popleft()
+        if exception:
+            self.failed += 1
+        else:
+            self.sent += 1
+            latency = monotonic() - message.queued_at
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+        if message.future.done():
+            return
+        if exception:
+            message.future.set_exception(exception)
+        else:
+            message.future.set_result(result)
+
+    @property
+    def stats(self) -> Dict:
+        depths = [len(messages) for messages in self.rooms.values()]
+        return {
+            "rooms": len(depths),
+            "depth": sum(depths),
+            "max_depth": max(depths, default=0),
+            "sent": self.sent,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "avg_latency": self.latency / self.sent if self.sent else 0,
+            "max_latency": self.max_latency,
+        }
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from functools import partial
+from time import time
+from typing import TYPE_CHECKING, Dict, Set
+
+from aiohttp import ClientSession
+from mautrix.util.logging import TraceLogger
+
+from .config import Config
+from .db.middleware_token import MiddlewareToken
+from .utils.lru_cache import LRUCache
+from .utils.single_flight import SingleFlight
+
+if TYPE_CHECKING:
+    from .middlewares.http import HTTPMiddleware
+    from .nodes.flow_object import FlowContext
+
+
+class TokenStore:
+    """It keeps the tokens of the jwt middlewares shared by the whole process.
+
+    The tokens are identified by the middleware ID and its rendered credentials, so all
+    the rooms that authenticate the same way use the same token, only one auth request
+    is made when several rooms need it at the same time and the tokens are saved in the
+    database to survive the restarts.
+
+    When the expiration of a token is known, it is refreshed in the background when it is used
+    less than refresh_margin seconds before it expires, so the requests don't have to be
+    rejected to get a new token. The background refreshes only update the store, the rooms
+    take the new token the next time they use it.
+    """
+
+    log: TraceLogger = logging.getLogger("menuflow.token_store")
+
+    def __init__(self, maxsize: int = 1024, refresh_margin: float = 60) -> None:
+        self.tokens = LRUCache(maxsize=maxsize)
+        self.refresh_margin = refresh_margin
+        self._flights = SingleFlight()
+        self._background_refreshes: Set[asyncio.Task] = set()
+        self.auth_requests = 0
+        self.loaded = 0
+        self.proactive_refreshes = 0
+        self.expired = 0
+
+    def init(self, config: Config) -> None:
+        self.refresh_margin = config["menuflow.tokens.refresh_margin"]
+
+    async def get_token(
+        self,
+        middleware: HTTPMiddleware,
+        context: FlowContext,
+        session: ClientSession,
+        save_variables: bool = True,
+    ) -> str | None:
+        """It returns the token of the middleware, it is loaded from the database
+        or requested to the auth endpoint if it is not known yet
+
+        Parameters
+        ----------
+        middleware : HTTPMiddleware
+            The middleware whose token is wanted.
+        context : FlowContext
+            The execution that needs the token.
+        session : ClientSession
+            The session used to make the auth request.
+        save_variables : bool
+            If the variables of the auth response are saved in the room of the context,
+            when the token has to be requested.
+
+        Returns
+        -------
+            The token or None if it could not be obtained.
+
+        """
+        key = middleware._credentials_key(context)
+        stored: MiddlewareToken | None = self.tokens.get(key)
+
+        if stored is None:
+            stored = await self._flights.run(
+                key,
+                partial(
+                    self._load, key, middleware, context, session, save_variables=save_variables
+                ),
+            )
+        elif stored.expires_at is not None and stored.expires_at <= time():
+            self.expired += 1
+            stored = await self._flights.run(
+                key,
+                partial(
+                    self._request, key, middleware, context, session, save_variables=save_variables
+                ),
+            )
+        elif stored.expires_at is not None and stored.expires_at - time() <= self.refresh_margin:
+            self._refresh_in_background(key, middleware, context, session)
+
+        return stored.token if stored else None
+
+    async def refresh(
+        self,
+        middleware: HTTPMiddleware,
+        context: FlowContext,
+        session: ClientSession,
+        stale_token: str | None,
+        save_variables: bool = True,
+    ) -> str | None:
+        """It requests a new token to replace the one that has been rejected
+
+        Parameters
+        ----------
+        middleware : HTTPMiddleware
+            The middleware whose token has been rejected.
+        context : FlowContext
+            The execution whose request has been rejected.
+        session : ClientSession
+            The session used to make the auth request.
+        stale_token : str | None
+            The token that has been rejected, if the stored token is already
+            a different one it has been refreshed by another request.
+        save_variables : bool
+            If the variables of the auth response are saved in the room of the context.
+
+        Returns
+        -------
+            The new token or None if it could not be obtained.
+
+        """
+        key = middleware._credentials_key(context)
+        stored: MiddlewareToken | None = self.tokens.get(key)
+        if stored is None or stored.token == stale_token:
+            stored = await self._flights.run(
+                key,
+                partial(
+                    self._request,
+                    key,
+                    middleware,
+                    context,
+                    session,
+                    save_variables=save_variables,
+                ),
+            )
+
+        return stored.token if stored else None
+
+    def _refresh_in_background(
+        self, key: str, middleware: HTTPMiddleware, context: FlowContext, session: ClientSession
+    ) -> None:
+        if key in self._flights:
+            return
+
+        async def refresh() -> None:
+            try:
+                await self._flights.run(
+                    key,
+                    partial(
+                        self._request, key, middleware, context, session, save_variables=False
+                    ),
+                )
+            except Exception as e:
+                self.log.exception(
+                    f"Error refreshing the token of the middleware {middleware.id}: {e}"
+                )
+
+        self.proactive_refreshes += 1
+        task = asyncio.create_task(refresh())
+        self._background_refreshes.add(task)
+        task.add_done_callback(self._background_refreshes.discard)
+
+    async def _load(
+        self,
+        key: str,
+        middleware: HTTPMiddleware,
+        context: FlowContext,
+        session: ClientSession,
+        save_variables: bool = True,
+    ) -> MiddlewareToken | None:
+        try:
+            stored = await MiddlewareToken.get(key)
+        except Exception as e:
+            self.log.exception(f"Error loading the token of the middleware {middleware.id}: {e}")
+            stored = None
+
+        if stored and (stored.expires_at is None or stored.expires_at > time()):
+            self.loaded += 1
+            self.tokens[key] = stored
+            return stored
+
+        return await self._request(
+            key, middleware, context, session, save_variables=save_variables
+        )
+
+    async def _request(
+        self,
+        key: str,
+        middleware: HTTPMiddleware,
+        context: FlowContext,
+        session: ClientSession,
+        save_variables: bool = True,
+    ) -> MiddlewareToken | None:
+        self.auth_requests += 1
+        result = await middleware.auth_request(
+            context=context, session=session, save_variables=save_variables
+        )
+        if not result:
+            return
+
+        _, variables, expires_at = result
+        token = variables.get(middleware._token_variable)
+        if not token:
+            self.log.warning(f"The middleware {middleware.id} did not obtain a token")
+            return
+
+        stored = MiddlewareToken(
+            key=key, middleware_id=middleware.id, token=token, expires_at=expires_at
+        )
+        self.tokens[key] = stored
+        try:
+            await stored.upsert()
+        except Exception as e:
+            self.log.exception(f"Error saving the token of the middleware {middleware.id}: {e}")
+
+        return stored
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            **self.tokens.stats,
+            "auth_requests": self.auth_requests,
+            "loaded": self.loaded,
+            "proactive_refreshes": self.proactive_refreshes,
+            "expired": self.expired,
+            "shared": self._flights.shared,
+        }
+
+
+token_store = TokenStore()
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict
+from urllib.parse import urlparse
+
+from aiohttp import ClientError
+from attr import dataclass
+from mautrix.util.logging import TraceLogger
+
+from .config import Config
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class CircuitOpenError(Exception):
+    """It is raised instead of making a request to an upstream whose circuit is open"""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"The circuit of the upstream {name} is open")
+        self.name = name
+
+
+@dataclass
+class UpstreamPolicy:
+    """How the requests to an upstream are retried and when its circuit is opened"""
+
+    retries: int = 2
+    # A request that has timed out has already made the room wait the whole timeout
+    retry_timeouts: bool = False
+    backoff: float = 0.5
+    max_backoff: float = 5
+    failure_threshold: int = 5
+    reset_timeout: float = 30
+
+    @classmethod
+    def from_dict(cls, data: Dict | None, default: UpstreamPolicy = None) -> UpstreamPolicy:
+        default = default or cls()
+        data = data or {}
+        return cls(
+            retries=int(data.get("retries", default.retries)),
+            retry_timeouts=bool(data.get("retry_timeouts", default.retry_timeouts)),
+            backoff=float(data.get("backoff", default.backoff)),
+            max_backoff=float(data.get("max_backoff", default.max_backoff)),
+            failure_threshold=int(data.get("failure_threshold", default.failure_threshold)),
+            reset_timeout=float(data.get("reset_timeout", default.reset_timeout)),
+        )
+
+    def delay(self, attempt: int) -> float:
+        """The exponential backoff with full jitter before the retry number attempt"""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """It stops the requests to an upstream after failure_threshold consecutive failures.
+
+    While the circuit is open the requests fail fast, after reset_timeout seconds it is
+    half-open and a single request is let through to probe the upstream, the circuit is
+    closed again if it succeeds or it is opened for another reset_timeout if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, policy: UpstreamPolicy) -> None:
+        self.name = name
+        self.policy = policy
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.requests = 0
+        self.total_failures = 0
+        self.rejected = 0
+        self.retries = 0
+        self.times_opened = 0
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN and monotonic() - self.opened_at >= self.policy.reset_timeout:
+            self.state = self.HALF_OPEN
+
+        if self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probing):
+            self._probing = self.state == self.HALF_OPEN
+            self.requests += 1
+            return True
+
+        self.rejected += 1
+        return False
+
+    def release(self) -> None:
+        """It lets another request probe the upstream when the probe has been cancelled"""
+        self._probing = False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.total_failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.policy.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = monotonic()
+        self._probing = False
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "requests": self.requests,
+            "failures": self.total_failures,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+        }
+
+
+class Upstreams:
+    """The retry policies and circuit breakers of the APIs called by the http_request nodes.
+
+    The policy of a request is the one of its middleware, if there is one configured,
+    otherwise the one of its host or the default one. There is a circuit breaker for each
+    middleware or host that has its own policy and another one for each of the other hosts.
+    """
+
+    log: TraceLogger = logging.getLogger("menuflow.upstreams")
+
+    def __init__(self) -> None:
+        self.default = UpstreamPolicy()
+        self.middlewares: Dict[str, UpstreamPolicy] = {}
+        self.hosts: Dict[str, UpstreamPolicy] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def init(self, config: Config) -> None:
+        self.default = UpstreamPolicy.from_dict(config["menuflow.upstreams.default"])
+        self.middlewares = {
+            middleware_id: UpstreamPolicy.from_dict(policy, self.default)
+            for middleware_id, policy in (config["menuflow.upstreams.middlewares"] or {}).items()
+        }
+        self.hosts = {
+            host: UpstreamPolicy.from_dict(policy, self.default)
+            for host, policy in (config["menuflow.upstreams.hosts"] or {}).items()
+        }
+        self.breakers = {}
+
+    def breaker(self, url: str, middleware_id: str = None) -> CircuitBreaker:
+        """It returns the circuit breaker of the upstream of a request
+
+        Parameters
+        ----------
+        url : str
+            The URL of the request.
+        middleware_id : str
+            The ID of the middleware of the request, if it has one.
+
+        Returns
+        -------
+            The circuit breaker, it is created the first time the upstream is used.
+
+        """
+        if middleware_id in self.middlewares:
+            name, policy = f"middleware:{middleware_id}", self.middlewares[middleware_id]
+        else:
+            host = urlparse(url).hostname or ""
+            name, policy = f"host:{host}", self.hosts.get(host, self.default)
+
+        try:
+            return self.breakers[name]
+        except KeyError:
+            breaker = self.breakers[name] = CircuitBreaker(name, policy)
+            return breaker
+
+    async def call(
+        self,
+        breaker: CircuitBreaker,
+        method: str,
+        fetch: Callable[[], Awaitable[Any]],
+        deadline: float = None,
+    ) -> Any:
+        """It makes a request through the circuit breaker of its upstream,
+        the idempotent requests are retried with a jittered exponential backoff
+        when they fail to connect or the upstream answers with a 5xx status.
+
+        Only the transport errors, the timeouts and the 5xx statuses count as failures of the
+        upstream, the other errors are raised without touching its circuit.
+
+        Parameters
+        ----------
+        breaker : CircuitBreaker
+            The circuit breaker of the upstream.
+        method : str
+            The method of the request.
+        fetch : Callable[[], Awaitable[Any]]
+            The function that makes the request, it returns an object with the status.
+        deadline : float
+            The seconds that all the attempts can take together, the attempts are cut
+            and not retried when it is reached.
+
+        Returns
+        -------
+            The response of the last attempt, if it failed with an exception it is raised.
+            CircuitOpenError is raised if the circuit is open.
+
+        """
+        retries = breaker.policy.retries if str(method).upper() in IDEMPOTENT_METHODS else 0
+        expires_at = monotonic() + deadline if deadline else None
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(breaker.name)
+
+            response = error = None
+            try:
+                if expires_at:
+                    response = await asyncio.wait_for(fetch(), expires_at - monotonic())
+                else:
+                    response = await fetch()
+            except asyncio.TimeoutError as e:
+                breaker.record_failure()
+                if attempt >= retries or not breaker.policy.retry_timeouts:
+                    raise
+                error = e
+            except ClientError as e:
+                breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                error = e
+            except BaseException:
+                # The errors reading the response, like a body too large, are not failures
+                # of the upstream, nor is the cancellation of the request
+                breaker.release()
+                raise
+            else:
+                if response.status < 500:
+                    breaker.record_success()
+                    return response
+
+                breaker.record_failure()
+                if attempt >= retries:
+                    return response
+
+            attempt += 1
+            delay = breaker.policy.delay(attempt)
+            if expires_at and monotonic() + delay >= expires_at:
+                self.log.warning(f"Request to {breaker.name} failed, no time left to retry it")
+                if error:
+                    raise error
+                return response
+
+            reason = repr(error) if error else f"status {response.status}"
+            self.log.warning(f"Request to {breaker.name} failed: {reason}, retrying ...")
+            breaker.retries += 1
+            await asyncio.sleep(delay)
+
+    @property
+    def stats(self) -> Dict[str, Dict]:
+        return {name: breaker.stats for name, breaker in self.breakers.items()}
+
+
+upstreams = Upstreams()
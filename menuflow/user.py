@@ -2,18 +2,21 @@ from __future__ import annotations
 
 from logging import getLogger
 from re import match
-from typing import Dict, cast
+from typing import cast
 
 from mautrix.types import UserID
 from mautrix.util.logging import TraceLogger
 
 from .config import Config
 from .db.user import User as DBUser
+from .utils.lru_cache import LRUCache
+from .utils.single_flight import SingleFlight
 
 
 class User(DBUser):
 
-    by_mxid: Dict[UserID, "User"] = {}
+    by_mxid: LRUCache = LRUCache(maxsize=10000, idle_ttl=3600)
+    _get_flights: SingleFlight = SingleFlight()
 
     config: Config
     log: TraceLogger = getLogger("menuflow.user")
@@ -26,6 +29,11 @@ class User(DBUser):
         super().__init__(id=id, mxid=mxid)
         self.log = self.log.getChild(self.mxid)
 
+    @classmethod
+    def init_cls(cls, config: Config) -> None:
+        cls.by_mxid.maxsize = config["menuflow.cache.users"]
+        cls.by_mxid.idle_ttl = config["menuflow.cache.idle_ttl"]
+
     def _add_to_cache(self) -> None:
         if self.mxid:
             self.by_mxid[self.mxid] = self
@@ -57,16 +65,20 @@ class User(DBUser):
         except KeyError:
             pass
 
-        user = cast(cls, await super().get_by_mxid(mxid))
+        # Concurrent events of the same user share a single database round trip
+        return await cls._get_flights.run((mxid, create), lambda: cls._load_by_mxid(mxid, create))
 
-        if user is not None:
-            user._add_to_cache()
-            return user
+    @classmethod
+    async def _load_by_mxid(cls, mxid: UserID, create: bool) -> "User" | None:
+        if mxid in cls.by_mxid:
+            return cls.by_mxid[mxid]
 
         if create:
-            user = cls(mxid=mxid)
-
-            await user.insert()
+            user = cast(cls, await super().get_or_create(mxid))
+        else:
             user = cast(cls, await super().get_by_mxid(mxid))
+
+        if user is not None:
             user._add_to_cache()
-            return user
+
+        return user
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import re
+from json import JSONDecodeError, loads
+from typing import Any, List, Tuple
+
+SEGMENT_REGEX = re.compile(r"([^\[\]]+)|\[(-?\d+)\]")
+
+
+def convert_to_bool(item: Any) -> Any:
+    """It converts the strings true and false, also inside dicts and lists, to booleans.
+    The dicts and lists are copied, the item can be a response shared by all the rooms.
+    """
+    if isinstance(item, dict):
+        return {k: convert_to_bool(v) for k, v in item.items()}
+    elif isinstance(item, list):
+        return [convert_to_bool(i) for i in item]
+    elif isinstance(item, str):
+        if item in ["True", "true"]:
+            return True
+        elif item in ["False", "false"]:
+            return False
+        else:
+            return item
+    else:
+        return item
+
+
+def typed_value(value: Any) -> Any:
+    """It gives a value taken from a response the same types that the rendered variables have,
+    the strings that contain JSON are decoded and the strings true and false are booleans
+    """
+    if isinstance(value, str):
+        try:
+            value = loads(value)
+        except JSONDecodeError:
+            pass
+    return convert_to_bool(value)
+
+
+class JSONPath:
+    """A path to a value inside a decoded JSON document, it is parsed once and then it can be
+    resolved against many documents.
+
+    The keys are separated by dots and the items of the lists are selected with their index
+    in brackets or as a key, for example `data.items[0].title` or `data.items.0.title`.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.segments: Tuple[str | int, ...] = tuple(self._parse(path))
+
+    def __repr__(self) -> str:
+        return f"JSONPath({self.path!r})"
+
+    @staticmethod
+    def _parse(path: str) -> List[str | int]:
+        segments = []
+        for part in str(path).split("."):
+            for key, index in SEGMENT_REGEX.findall(part):
+                segments.append(int(index) if index else key)
+        return segments
+
+    def resolve(self, data: Any) -> Any:
+        """It returns the value of the path in the document
+
+        Parameters
+        ----------
+        data : Any
+            The decoded JSON document.
+
+        Returns
+        -------
+            The value, a KeyError is raised if the path doesn't exist in the document.
+
+        """
+        value = data
+        for segment in self.segments:
+            try:
+                if isinstance(value, list):
+                    value = value[int(segment)]
+                elif isinstance(value, dict):
+                    value = value[segment if isinstance(segment, str) else str(segment)]
+                else:
+                    raise KeyError(segment)
+            except (IndexError, ValueError):
+                raise KeyError(self.path)
+        return value
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Dict, Hashable, Iterator, List, Tuple
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used entry when it is full,
+    it keeps track of the hits, misses and evictions to be exposed in the stats.
+
+    If idle_ttl is set, the entries that have not been used for that many seconds
+    are also evicted.
+    """
+
+    def __init__(self, maxsize: int = 1024, idle_ttl: float | None = None) -> None:
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._last_used: Dict[Hashable, float] = {}
+        self._maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __getitem__(self, key: Hashable) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        self._touch(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self.set(key, value)
+
+    def _touch(self, key: Hashable) -> None:
+        self._data.move_to_end(key)
+        if self.idle_ttl:
+            self._last_used[key] = monotonic()
+
+    def _evict(self) -> List[Tuple[Hashable, Any]]:
+        evicted = []
+
+        if self.idle_ttl:
+            # The entries are sorted by use, so the idle ones are always at the beginning
+            deadline = monotonic() - self.idle_ttl
+            while self._data:
+                key = next(iter(self._data))
+                if self._last_used.get(key, 0) > deadline:
+                    break
+                evicted.append((key, self.pop(key)))
+                self.expirations += 1
+
+        while len(self._data) > max(self._maxsize, 0):
+            key, value = self._data.popitem(last=False)
+            self._last_used.pop(key, None)
+            evicted.append((key, value))
+            self.evictions += 1
+
+        return evicted
+
+    def set(self, key: Hashable, value: Any) -> List[Tuple[Hashable, Any]]:
+        """It adds the entry as the most recently used one
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the entry.
+        value : Any
+            The value of the entry.
+
+        Returns
+        -------
+            The entries that have been evicted because they were idle or the cache was full.
+
+        """
+        self._data[key] = value
+        self._touch(key)
+        return self._evict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """It returns the value of the key and marks it as the most recently used
+
+        Parameters
+        ----------
+        key : Hashable
+            The key of the entry.
+        default : Any
+            The value returned when the key is not in the cache.
+
+        Returns
+        -------
+            The cached value or the default one.
+
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """It returns the value of the key without marking it as used nor counting a hit"""
+        return self._data.get(key, default)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self._last_used.pop(key, None)
+        return self._data.pop(key, default)
+
+    def values(self) -> Iterator[Any]:
+        return iter(list(self._data.values()))
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._last_used.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "maxsize": self._maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
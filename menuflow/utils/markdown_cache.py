@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from markdown import markdown
+
+from .lru_cache import LRUCache
+
+markdown_cache = LRUCache()
+"""
+HTML of the rendered texts of the messages, shared by every client of the process,
+keyed by the markdown source.
+"""
+
+
+def render_markdown(text: str) -> str:
+    """It converts a markdown text to HTML,
+    the text is only converted the first time it is requested
+
+    Parameters
+    ----------
+    text : str
+        The markdown text.
+
+    Returns
+    -------
+        The HTML of the text.
+
+    """
+
+    html: str = markdown_cache.get(text)
+
+    if html is None:
+        html = markdown(text)
+        markdown_cache[text] = html
+
+    return html
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+from typing import Any
+
+from aiohttp import ClientResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson:
+    json_loads = orjson.loads
+else:
+    from json import loads as json_loads
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ResponseTooLarge(Exception):
+    """It is raised when the body of a response is bigger than the allowed size"""
+
+    def __init__(self, url: str, max_size: int) -> None:
+        super().__init__(f"The response of {url} is bigger than {max_size} bytes")
+
+
+async def read_body(response: ClientResponse, max_size: int | None) -> bytes:
+    """It reads the body of a response by chunks and stops as soon as it is too large
+
+    Parameters
+    ----------
+    response : ClientResponse
+        The response whose body is read.
+    max_size : int | None
+        The maximum size of the body in bytes, there is no limit if it is not set.
+
+    Returns
+    -------
+        The body, ResponseTooLarge is raised if it is bigger than max_size.
+
+    """
+    if max_size and response.content_length and response.content_length > max_size:
+        raise ResponseTooLarge(str(response.url), max_size)
+
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        body.extend(chunk)
+        if max_size and len(body) > max_size:
+            raise ResponseTooLarge(str(response.url), max_size)
+    return bytes(body)
+
+
+def decode_json(body: bytes, content_type: str) -> Any:
+    """It decodes the body if it is JSON, with orjson if it is installed
+
+    Parameters
+    ----------
+    body : bytes
+        The body of the response.
+    content_type : str
+        The content type of the response.
+
+    Returns
+    -------
+        The decoded document, or an empty dict if the body is not JSON.
+
+    """
+    if not body or not (content_type or "").endswith("json"):
+        return {}
+
+    try:
+        return json_loads(body)
+    except ValueError:
+        return {}
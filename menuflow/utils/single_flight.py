@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """It runs only one call at a time for each key,
+    the concurrent callers of the same key wait for the call in flight and share its result.
+
+    The call goes on while any of its callers waits for it, it is cancelled when all of them
+    have been cancelled.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        # The number of callers waiting for each call in flight
+        self._waiters: Dict[asyncio.Future, int] = {}
+        self.calls = 0
+        self.shared = 0
+        self.cancelled = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+        # The exception is retrieved even if no caller is left to read it
+        if future.done() and not future.cancelled():
+            future.exception()
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """It runs the function, unless there is already a call in flight for the key,
+        in that case it waits for that call instead
+
+        Parameters
+        ----------
+        key : Hashable
+            The key that identifies the call.
+        fn : Callable[[], Awaitable[Any]]
+            The function that makes the call.
+
+        Returns
+        -------
+            The result of the call, the exceptions are raised to all the callers.
+
+        """
+        try:
+            future = self._calls[key]
+        except KeyError:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+            self.calls += 1
+        else:
+            self.shared += 1
+
+        self._waiters[future] = self._waiters.get(future, 0) + 1
+        try:
+            # The call must not be cancelled when one of the callers is cancelled
+            return await asyncio.shield(future)
+        finally:
+            self._waiters[future] -= 1
+            if not self._waiters[future]:
+                del self._waiters[future]
+                if not future.done():
+                    # There is no one left waiting for the result
+                    self.cancelled += 1
+                    future.cancel()
+                    self._forget(key, future)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "shared": self.shared,
+            "cancelled": self.cancelled,
+        }
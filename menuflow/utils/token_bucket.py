@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import asyncio
+from time import monotonic
+
+
+class TokenBucket:
+    """It limits the rate of an operation to `rate` per second, allowing bursts of up to
+    `burst` operations after it has been idle. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self) -> float:
+        """The time to wait until an operation can be done"""
+        now = monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        if not self.rate:
+            return 0
+
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def acquire(self) -> None:
+        """It waits until an operation can be done and takes a token for it"""
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        if self.rate:
+            self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """It stops the operations for some seconds, the bucket is empty when it resumes"""
+        self.paused_until = max(self.paused_until, monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
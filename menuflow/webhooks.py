@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+from time import time
+from typing import Any, Dict, List
+
+from aiohttp import BasicAuth, ClientTimeout
+from mautrix.util.logging import TraceLogger
+
+from .config import Config
+from .db.webhook_job import WebhookJob
+from .http_pool import http_pool
+
+
+class WebhookQueue:
+    """The queue of the requests of the webhook nodes, they are sent in the background
+    by a fixed number of workers so the rooms don't wait for them.
+
+    The queued requests are also saved in the database until they are sent, the ones
+    that are pending when the process stops are queued again when it starts, a batch at
+    a time each time the queue is empty. When the queue is full the new requests are dropped.
+    """
+
+    log: TraceLogger = logging.getLogger("menuflow.webhooks")
+
+    def __init__(self) -> None:
+        self.queue_size = 1000
+        self.workers = 4
+        self.retries = 3
+        self.backoff = 1.0
+        self.timeout = 10
+        self._queue: asyncio.Queue | None = None
+        self._workers: List[asyncio.Task] = []
+        self._restorer: asyncio.Task | None = None
+        self.enqueued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.restored = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def init(self, config: Config) -> None:
+        self.queue_size = config["menuflow.webhooks.queue_size"]
+        self.workers = config["menuflow.webhooks.workers"]
+        self.retries = config["menuflow.webhooks.retries"]
+        self.backoff = config["menuflow.webhooks.backoff"]
+        self.timeout = config["menuflow.timeouts.http_request"]
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._restorer = asyncio.create_task(self._restore())
+
+    async def stop(self) -> None:
+        tasks = [*self._workers, self._restorer] if self._restorer else self._workers
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._restorer = None
+
+    async def _restore(self) -> None:
+        """It queues again the jobs that were pending when the process started.
+
+        They are loaded in batches of the size of the queue, the next one when the queue
+        is empty, so they don't take the place of the new requests. Only the jobs saved
+        before the start are loaded, the newer ones are already in the queue.
+        """
+        try:
+            until_id = await WebhookJob.get_last_id()
+            after_id = 0
+            while until_id:
+                jobs = await WebhookJob.get_pending(
+                    limit=self.queue_size, after_id=after_id, until_id=until_id
+                )
+                for job in jobs:
+                    await self._queue.put(job)
+                self.restored += len(jobs)
+
+                if len(jobs) < self.queue_size:
+                    break
+                after_id = jobs[-1].id
+                await self._queue.join()
+        except Exception as e:
+            self.log.exception(f"Error loading the pending webhooks: {e}")
+
+        if self.restored:
+            self.log.info(f"{self.restored} pending webhooks have been queued again")
+
+    async def enqueue(self, request: Dict[str, Any]) -> bool:
+        """It saves the request and queues it to be sent in the background
+
+        Parameters
+        ----------
+        request : Dict[str, Any]
+            The rendered request: method, url and optionally params, headers, json
+            and basic_auth.
+
+        Returns
+        -------
+            False if the request has been dropped because the queue is full.
+
+        """
+        if self._queue is None or self._queue.full():
+            self.dropped += 1
+            self.log.warning(f"The webhook queue is full, dropping request to {request['url']}")
+            return False
+
+        job = WebhookJob(id=None, request=request, created_at=time())
+        try:
+            await job.insert()
+        except Exception as e:
+            self.log.exception(f"Error saving the webhook to {request['url']}: {e}")
+
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self.log.warning(f"The webhook queue is full, dropping request to {request['url']}")
+            await self._forget(job)
+            return False
+
+        self.enqueued += 1
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            job: WebhookJob = await self._queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                self.log.exception(f"Error sending the webhook {job.id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, job: WebhookJob) -> None:
+        url = job.request["url"]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+            try:
+                status = await self._send(job.request)
+            except Exception as e:
+                self.log.warning(f"The webhook to {url} failed: {e!r}")
+                continue
+
+            # The client errors are not retried, the request would be rejected again
+            if status < 500 and status != 429:
+                break
+            self.log.warning(f"The webhook to {url} got the status {status}")
+        else:
+            status = None
+
+        if status and 200 <= status < 300:
+            self.delivered += 1
+        else:
+            self.failed += 1
+            self.log.error(f"The webhook to {url} could not be delivered, status: {status}")
+
+        latency = time() - job.created_at
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        await self._forget(job)
+
+    async def _send(self, request: Dict[str, Any]) -> int:
+        kwargs = {}
+        for arg in ("params", "headers", "json"):
+            if request.get(arg):
+                kwargs[arg] = request[arg]
+
+        if request.get("basic_auth"):
+            kwargs["auth"] = BasicAuth(
+                login=request["basic_auth"]["login"], password=request["basic_auth"]["password"]
+            )
+
+        async with http_pool.session.request(
+            request["method"], request["url"], timeout=ClientTimeout(total=self.timeout), **kwargs
+        ) as response:
+            return response.status
+
+    async def _forget(self, job: WebhookJob) -> None:
+        if job.id is None:
+            return
+
+        try:
+            await job.delete()
+        except Exception as e:
+            self.log.exception(f"Error removing the webhook {job.id}: {e}")
+
+    @property
+    def stats(self) -> Dict:
+        finished = self.delivered + self.failed
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "queue_size": self.queue_size,
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retried,
+            "restored": self.restored,
+            "avg_latency": self.latency / finished if finished else 0,
+            "max_latency": self.max_latency,
+        }
+
+
+webhook_queue = WebhookQueue()
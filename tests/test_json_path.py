@@ -0,0 +1,10 @@
+from menuflow.utils.json_path import typed_value
+
+
+def test_typed_value_does_not_change_the_response():
+    data = {"active": "true", "items": [{"done": "false"}]}
+
+    value = typed_value(data)
+
+    assert value == {"active": True, "items": [{"done": False}]}
+    assert data == {"active": "true", "items": [{"done": "false"}]}
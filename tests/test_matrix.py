@@ -0,0 +1,150 @@
+import asyncio
+import logging
+
+from menuflow.db.room import RoomState
+from menuflow.http_pool import http_pool
+from menuflow.matrix import MatrixHandler
+
+
+class FakeRoom:
+    def __init__(self, node_id: str) -> None:
+        self.room_id = "!room:example.com"
+        self.node_id = node_id
+        self.state = None
+        self.variables_version = 0
+
+    async def update_menu(self, node_id: str, state: str = None) -> None:
+        self.node_id = node_id
+        self.state = state
+
+
+class FakeMiddleware:
+    id = "api_jwt"
+    _attempts = 3
+
+
+class FakeHTTPRequest:
+    """An http_request node whose API always answers 401"""
+
+    id = "request"
+    type = "http_request"
+    middleware = FakeMiddleware.id
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def request(self, context, session, middleware):
+        self.calls += 1
+        return 401, "Unauthorized"
+
+    async def get_case_by_id(self, id, context):
+        return "fallback"
+
+
+class FakeFlow:
+    flow_variables = {}
+
+    def __init__(self, nodes) -> None:
+        self.nodes_by_id = {node.id: node for node in nodes}
+
+    def node(self, room):
+        return self.nodes_by_id.get(room.node_id)
+
+    def middleware(self, middleware_id):
+        return FakeMiddleware() if middleware_id == FakeMiddleware.id else None
+
+
+class FakeEnd:
+    id = "fallback"
+    type = "message"
+
+
+def make_handler(flow: FakeFlow) -> MatrixHandler:
+    handler = MatrixHandler.__new__(MatrixHandler)
+    handler.log = logging.getLogger("test")
+    handler.config = {"menuflow.executor.max_steps": 20}
+    handler.flow = flow
+    handler.HTTP_ATTEMPTS = {}
+    handler.executor_stats = {
+        "runs": 0,
+        "steps": 0,
+        "max_steps": 0,
+        "time": 0.0,
+        "cycles": 0,
+        "budget_exceeded": 0,
+        "nodes": 0,
+        "max_nodes": 0,
+    }
+    return handler
+
+
+def test_http_request_401_is_retried_until_the_default_case(monkeypatch):
+    node = FakeHTTPRequest()
+    handler = make_handler(FakeFlow([node, FakeEnd()]))
+    room = FakeRoom(node_id=node.id)
+    monkeypatch.setattr(http_pool, "_session", type("Session", (), {"closed": False})())
+
+    async def run_node(node, context, evt=None):
+        if node.type == "http_request":
+            return await handler.run_http_request(node=node, context=context)
+        await room.update_menu(node_id=RoomState.END.value, state=RoomState.END.value)
+        return True
+
+    handler.run_node = run_node
+    asyncio.run(handler.algorithm(room=room))
+
+    # The token is refreshed by the middleware without changing any variable of the room,
+    # the node is still run once per attempt and then the room goes to the default case
+    assert node.calls == FakeMiddleware._attempts
+    assert handler.executor_stats["cycles"] == 0
+    assert room.node_id == RoomState.START.value
+
+
+def test_http_request_401_without_middleware_is_a_loop():
+    node = FakeHTTPRequest()
+    node.middleware = None
+    handler = make_handler(FakeFlow([node]))
+    room = FakeRoom(node_id=node.id)
+
+    async def run_node(node, context, evt=None):
+        await node.request(context=context, session=None, middleware=None)
+        return True
+
+    handler.run_node = run_node
+    asyncio.run(handler.algorithm(room=room))
+
+    assert node.calls == 1
+    assert handler.executor_stats["cycles"] == 1
+
+
+class FakeCounter:
+    """A node that sets a variable of the room and goes to the next node"""
+
+    type = "set_vars"
+
+    def __init__(self, id: str, o_connection: str) -> None:
+        self.id = id
+        self.o_connection = o_connection
+        self.calls = 0
+
+
+def test_execution_stops_when_the_step_budget_is_spent():
+    nodes = [FakeCounter("a", "b"), FakeCounter("b", "a")]
+    handler = make_handler(FakeFlow(nodes))
+    room = FakeRoom(node_id="a")
+
+    async def run_node(node, context, evt=None):
+        # Each step changes the variables, so the flow is making progress and it isn't a loop
+        node.calls += 1
+        room.variables_version += 1
+        await room.update_menu(node_id=node.o_connection)
+        return True
+
+    handler.run_node = run_node
+    asyncio.run(handler.algorithm(room=room))
+
+    assert sum(node.calls for node in nodes) == 20
+    assert handler.executor_stats["budget_exceeded"] == 1
+    assert handler.executor_stats["cycles"] == 0
+    assert handler.executor_stats["steps"] == handler.executor_stats["max_steps"] == 20
+    assert handler.executor_stats["nodes"] == handler.executor_stats["max_nodes"] == 2
@@ -0,0 +1,69 @@
+import asyncio
+
+from menuflow.nodes import ParallelRequest
+from menuflow.nodes.flow_object import FlowContext
+from menuflow.room import Room
+
+CONFIG = {
+    "menuflow.timeouts.http_request": 10,
+    "menuflow.http_client.max_body_size": 1048576,
+}
+
+
+class SlowSession:
+    """A session whose requests never answer, it counts the ones in flight"""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.requests = 0
+
+    def request(self, method, url, **kwargs):
+        return SlowRequest(self)
+
+
+class SlowRequest:
+    def __init__(self, session: SlowSession) -> None:
+        self.session = session
+
+    async def __aenter__(self):
+        self.session.in_flight += 1
+        self.session.requests += 1
+        try:
+            await asyncio.sleep(60)
+        finally:
+            self.session.in_flight -= 1
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+
+def test_timeout_cancels_the_requests_in_flight():
+    node = ParallelRequest.deserialize(
+        {
+            "id": "p1",
+            "type": "parallel_request",
+            "timeout": 0.05,
+            "requests": [
+                {"id": "news", "method": "GET", "url": "https://news.example.com/today"},
+                {"id": "weather", "method": "GET", "url": "https://weather.example.com/today"},
+            ],
+            "cases": [
+                {"id": "all_ok", "o_connection": "m1"},
+                {"id": "timeout", "o_connection": "m2"},
+                {"id": "default", "o_connection": "m3"},
+            ],
+        }
+    )
+    session = SlowSession()
+
+    async def run():
+        room = Room(room_id="!room:example.com", node_id="p1")
+        context = FlowContext(room=room, config=CONFIG)
+        o_connection = await node.run(context, session, get_middleware=lambda _: None)
+
+        # Nothing is left running once the room has taken the timeout case
+        assert o_connection == "m2"
+        assert session.requests == 2
+        assert session.in_flight == 0
+
+    asyncio.run(run())
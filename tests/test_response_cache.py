@@ -0,0 +1,33 @@
+import asyncio
+import sqlite3
+
+from menuflow.response_cache import CachedResponse, ResponseCache
+
+
+def test_store_keeps_only_the_cached_responses(tmp_path):
+    config = {
+        "menuflow.cache.responses": 2,
+        "menuflow.cache.responses_store": str(tmp_path / "responses.db"),
+    }
+
+    async def save():
+        cache = ResponseCache()
+        cache.init(config)
+        for i in range(3):
+            response = CachedResponse(status=200, body=b"\x00{}", data={"i": i})
+            cache.set(f"k{i}", response, ttl=60, stale_while_revalidate=0)
+        await cache.close()
+
+    asyncio.run(save())
+
+    # The first response was evicted from the cache, so it is removed from the store too
+    keys = sqlite3.connect(config["menuflow.cache.responses_store"]).execute(
+        "SELECT key FROM response ORDER BY key"
+    )
+    assert [key for key, in keys] == ["k1", "k2"]
+
+    cache = ResponseCache()
+    cache.init(config)
+    response, fresh = cache.get("k2")
+    assert fresh and response.body == b"\x00{}" and response.data == {"i": 2}
+    asyncio.run(cache.close())
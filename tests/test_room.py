@@ -0,0 +1,36 @@
+import asyncio
+
+from menuflow.room import Room
+
+
+class SlowDB:
+    """A database whose partial updates are slow, it records the queries in order"""
+
+    def __init__(self) -> None:
+        self.queries = []
+
+    async def execute(self, query: str, *args) -> None:
+        if "||" in query:
+            await asyncio.sleep(0.05)
+        self.queries.append((query, args))
+
+
+def test_clean_up_is_not_overwritten_by_a_flush_in_progress(monkeypatch):
+    db = SlowDB()
+    monkeypatch.setattr(Room, "db", db)
+
+    async def main():
+        room = Room(room_id="!room:example.com", node_id="m1")
+        await room.set_variable("name", "old")
+        flush = asyncio.create_task(room.flush())
+        await asyncio.sleep(0)
+
+        await room.clean_up()
+        await flush
+
+        query, args = db.queries[-1]
+        assert "||" not in query
+        assert args[1] == "{}"
+        assert not room.dirty
+
+    asyncio.run(main())
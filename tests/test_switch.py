@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+from menuflow.jinja.jinja_template import get_template
+from menuflow.nodes import Switch
+from menuflow.nodes.flow_object import FlowContext
+from menuflow.room import Room
+
+
+@pytest.mark.parametrize("opt", ["a & <b>", "true", "5", {"a": "b"}, None])
+def test_compiled_validation_matches_the_rendered_one(opt):
+    node = Switch.deserialize(
+        {"id": "s1", "type": "switch", "validation": "{{ opt }}", "cases": []}
+    )
+    assert node._validation is not None
+
+    room = Room(room_id="!room:example.com", node_id="s1", variables=json.dumps({"opt": opt}))
+    context = FlowContext(room=room, config={})
+
+    rendered = node._render_string(get_template(node.validation), context.variables)
+    assert node._validate(context) == rendered